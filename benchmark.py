@@ -0,0 +1,471 @@
+""" Load Generator and Benchmark
+
+This script simulates a number of boards streaming a song from the server at
+the same time, using the same requests as echoclient.py, and measures how
+fast the frames come back. Every combination of stream mode, batch size,
+frame size, point width and RCVD on/off given on the command line is run in
+turn, and the results are written to a JSON file so that two server builds
+can be compared on the same machine:
+
+    python benchmark.py --boards=8 --modes=sep,batch,song --batches=16,256 \\
+        --frame-sizes=256,1024 --rcvd=on,off --label=baseline
+
+Options:
+
+--server=HOST:PORT   server to benchmark (127.0.0.1:9091)
+--boards=N           number of boards streaming at once (4)
+--modes=LIST         stream modes to run: sep, batch, song (all three)
+--batches=LIST       frames per NEXT in batch mode (16,256)
+--frame-sizes=LIST   frame sizes in bytes (1024)
+--bits=LIST          point widths to ask for: 8, 12, 16 or 32 (32)
+--endian=E           byte order to ask for, little or big (server's own)
+--spectrum=S         full or half spectrum (full)
+--hop=N              samples between FFT windows (the server's FFT size)
+--fft-window=W       window function: rect, hann, hamming or blackman (rect)
+--rcvd=LIST          on, off or both (on,off)
+--window=N           frames in flight with RCVD on a persistent connection (32)
+--persistent         one connection per board instead of one per request
+--frames=N           stop each board after N frames, 0 for the whole song (0)
+--song=NAME          song to stream (the first one in SONG_LIST)
+--label=NAME         name of the server build, stored with the results
+--output=FILE        JSON results file (benchmark.json)
+
+Boards that open a connection per request are told apart by the server by
+their address, so each one connects from its own 127.0.0.x address when the
+server is on loopback. The stream mode is picked per board with the stream
+START option, so the server can run with its default mode.
+"""
+
+import json
+import math
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+import frames
+import packets
+
+PACKET = packets.all_packets()
+
+BUFFER_SIZE = 8192
+HEADER_SIZE = 4
+LAST_FRAME = b"\xFF\xFF\xFF\xFF"
+
+# stream modes, as numbered by the server
+STREAM_MODES = {'sep': 1, 'batch': 2, 'song': 3}
+
+SERVER_ADDR = '127.0.0.1'
+SERVER_PORT = 9091
+BOARDS = 4
+MODES = ['sep', 'batch', 'song']
+BATCHES = [16, 256]
+FRAME_SIZES = [1024]
+BITS = [32]
+ENDIAN = None
+SPECTRUM = None
+HOP = None
+FFT_WINDOW = None
+RCVD = ['on', 'off']
+WINDOW = 32
+PERSISTENT = False
+MAX_FRAMES = 0
+SONG = None
+LABEL = ""
+OUTPUT = "benchmark.json"
+
+# seconds to wait on any one socket operation before giving up on a board
+TIMEOUT = 60
+
+class BoardResult(object):
+    """ Timings collected by one simulated board. """
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.ttff = None
+        self.gaps = []
+        self.error = None
+        self.last_arrival = None
+
+    def frame_arrived(self, start, record_size):
+        now = time.perf_counter()
+        if self.last_arrival is None:
+            self.ttff = now - start
+        else:
+            self.gaps.append(now - self.last_arrival)
+        self.last_arrival = now
+        self.frames += 1
+        self.bytes += record_size
+
+def parse_list(value, convert=str):
+    return [convert(item) for item in value.split(',') if item]
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of values, None if there are none. """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+def latency_summary(values):
+    """ p50/p99/p999 and max of a list of seconds, in milliseconds. """
+    summary = {}
+    for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        value = percentile(values, fraction)
+        summary[name] = None if value is None else value * 1e3
+    summary['max'] = max(values) * 1e3 if values else None
+    return summary
+
+def source_address(board):
+    # boards on one host share a session unless they connect from
+    # different addresses, which loopback gives us for free
+    if SERVER_ADDR.startswith('127.'):
+        return ('127.0.0.{}'.format(2 + board % 250), 0)
+    return None
+
+def connect(board):
+    sock = socket.create_connection((SERVER_ADDR, SERVER_PORT), TIMEOUT,
+                                    source_address(board))
+    # small requests go out right away rather than waiting for an ACK
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def request(board, message):
+    """ Sends message on a connection of its own and returns the reply. """
+    with connect(board) as sock:
+        sock.sendall(message)
+        reply = b""
+        while True:
+            chunk = sock.recv(BUFFER_SIZE)
+            if not chunk:
+                return reply
+            reply += chunk
+
+def song_list():
+    reply = request(0, PACKET['SONG_LIST'])
+    return reply.decode('ascii').split('\x03')[:-1]
+
+def server_stats():
+    """ Counters from the server's STATS reply, None if it has none. """
+    try:
+        reply = request(0, PACKET['STATS'])
+    except OSError:
+        return None
+    if len(reply) < 4:
+        return None
+    snapshot = json.loads(reply[4:].decode('utf-8'))
+    snapshot.pop('sessions', None)
+    return snapshot
+
+def read_records(stream, count, result, start, record_size):
+    """ Reads up to count records from a socket file. Returns True at the
+    last frame of the song.
+    """
+    for i in range(count):
+        record = stream.read(record_size)
+        if len(record) < record_size:
+            raise ConnectionError("stream ended after {} frames".format(
+                result.frames))
+        index = int.from_bytes(record[:HEADER_SIZE], ENDIAN or sys.byteorder,
+                               signed=True)
+        if record[:HEADER_SIZE] != LAST_FRAME and index != result.frames:
+            # a skipped frame would make every number of the run meaningless
+            raise ConnectionError("frame {} arrived after {} frames".format(
+                index, result.frames))
+        result.frame_arrived(start, record_size)
+        if record[:HEADER_SIZE] == LAST_FRAME:
+            return True
+    return False
+
+def check_length(board, song, result):
+    """ Fails the board unless it got every frame of song, as counted by the
+    session the server reports for it in STATS.
+    """
+    reply = request(board, PACKET['STATS'])
+    snapshot = json.loads(reply[4:].decode('utf-8'))
+    source = source_address(board)
+    for sess in snapshot.get('sessions', []):
+        if os.path.basename(sess['song']) == song and \
+                (source is None or sess['address'] == source[0]):
+            if sess['frames'] != result.frames:
+                raise ConnectionError("got {} of {} frames".format(
+                    result.frames, sess['frames']))
+            return
+    raise ConnectionError("no session streaming " + song)
+
+def next_message(mode, batch):
+    if mode == 'batch':
+        return PACKET['NEXT'] + batch.to_bytes(2, byteorder='big')
+    return PACKET['NEXT']
+
+def frames_per_next(mode, batch):
+    if mode == 'batch':
+        return batch
+    if mode == 'sep':
+        return 1
+    return sys.maxsize
+
+def start_options(mode, bits):
+    options = {'stream': STREAM_MODES[mode], 'bits': bits}
+    if ENDIAN:
+        options['endian'] = ENDIAN
+    if SPECTRUM:
+        options['spectrum'] = SPECTRUM
+    if HOP:
+        options['hop'] = HOP
+    if FFT_WINDOW:
+        options['fft_window'] = FFT_WINDOW
+    return options
+
+def run_board_per_request(board, song, mode, batch, frame_size, bits, rcvd,
+                          result, barrier):
+    """ Streams a song the way the original firmware does: a new connection
+    for START and for every NEXT, with the RCVD sent on the connection of
+    the NEXT it acknowledges.
+    """
+    record_size = HEADER_SIZE + frames.frame_bytes(bits, frame_size)
+    options = start_options(mode, bits)
+    barrier.wait()
+    start = time.perf_counter()
+    reply = request(board, packets.encode_start(song, frame_size, options))
+    if reply[:1] != PACKET['START_ACK']:
+        raise ConnectionError("no START_ACK, got {!r}".format(reply))
+
+    end_of_song = False
+    while not end_of_song:
+        with connect(board) as sock:
+            sock.sendall(next_message(mode, batch))
+            with sock.makefile('rb') as stream:
+                end_of_song = read_records(stream,
+                                           frames_per_next(mode, batch),
+                                           result, start, record_size)
+            if rcvd:
+                # on the same connection, as echoclient.py does: a RCVD of
+                # its own would move the session's cursor past a frame
+                try:
+                    sock.sendall(PACKET['RCVD'])
+                except OSError:
+                    # the server may have closed it already
+                    pass
+        if MAX_FRAMES and result.frames >= MAX_FRAMES:
+            break
+    if end_of_song:
+        check_length(board, song, result)
+    request(board, PACKET['STOP'])
+
+def run_board_persistent(board, song, mode, batch, frame_size, bits, rcvd,
+                         result, barrier):
+    """ Streams a song over one connection, acknowledging every frame with
+    a windowed RCVD when rcvd is set.
+    """
+    record_size = HEADER_SIZE + frames.frame_bytes(bits, frame_size)
+    options = start_options(mode, bits)
+    options['persist'] = 1
+    if rcvd:
+        options['window'] = WINDOW
+    barrier.wait()
+    start = time.perf_counter()
+    with connect(board) as sock, sock.makefile('rb') as stream:
+        sock.sendall(packets.encode_start(song, frame_size, options))
+        reply = stream.read(1)
+        if reply != PACKET['START_ACK']:
+            raise ConnectionError("no START_ACK, got {!r}".format(reply))
+
+        per_next = frames_per_next(mode, batch)
+        end_of_song = False
+        while not end_of_song:
+            sock.sendall(next_message(mode, batch))
+            received = 0
+            while received < per_next and not end_of_song:
+                # acknowledge frame by frame so the window keeps moving
+                count = 1 if rcvd else per_next - received
+                end_of_song = read_records(stream, count, result, start,
+                                           record_size)
+                received += count
+                if rcvd:
+                    sock.sendall(packets.encode_rcvd(
+                        -1 if end_of_song else result.frames - 1))
+            if MAX_FRAMES and result.frames >= MAX_FRAMES:
+                break
+        if end_of_song:
+            check_length(board, song, result)
+
+        # anything still in flight is dropped by the server at STOP
+        sock.sendall(PACKET['STOP'])
+        while True:
+            header = stream.read(1)
+            if header in (PACKET['STOP_ACK'], b""):
+                break
+
+def run_board(board, song, mode, batch, frame_size, bits, rcvd, result,
+              barrier):
+    if PERSISTENT:
+        target = run_board_persistent
+    else:
+        target = run_board_per_request
+    try:
+        target(board, song, mode, batch, frame_size, bits, rcvd, result,
+               barrier)
+    except (OSError, threading.BrokenBarrierError) as e:
+        result.error = str(e)
+
+def run(song, mode, batch, frame_size, bits, rcvd):
+    """ Streams song to BOARDS boards at once and summarizes the timings.
+
+    Args:
+        song: Name of the song, as listed by SONG_LIST.
+        mode: 'sep', 'batch' or 'song'.
+        batch: Frames asked for by each NEXT in batch mode.
+        frame_size: Number of bytes in each frame.
+        bits: Point width to ask for.
+        rcvd: Whether boards acknowledge the frames they receive.
+
+    Returns:
+        A dict with the parameters of the run and its results.
+    """
+    results = [BoardResult() for board in range(BOARDS)]
+    # the clock starts once every board is ready to send START
+    barrier = threading.Barrier(BOARDS + 1)
+    threads = [threading.Thread(target=run_board,
+                                args=(board, song, mode, batch, frame_size,
+                                      bits, rcvd, results[board], barrier))
+               for board in range(BOARDS)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    num_frames = sum(result.frames for result in results)
+    num_bytes = sum(result.bytes for result in results)
+    ttffs = [result.ttff for result in results if result.ttff is not None]
+    gaps = [gap for result in results for gap in result.gaps]
+    return {'mode': mode,
+            'batch': batch if mode == 'batch' else None,
+            'frame_size': frame_size,
+            'bits': bits,
+            'endian': ENDIAN,
+            'spectrum': SPECTRUM or 'full',
+            'hop': HOP,
+            'fft_window': FFT_WINDOW or 'rect',
+            'rcvd': rcvd,
+            'persistent': PERSISTENT,
+            'boards': BOARDS,
+            'elapsed_s': elapsed,
+            'frames': num_frames,
+            'bytes': num_bytes,
+            'frames_per_s': num_frames / elapsed,
+            'mb_per_s': num_bytes / elapsed / 1e6,
+            'ttff_ms': latency_summary(ttffs),
+            'inter_frame_ms': latency_summary(gaps),
+            'errors': [result.error for result in results if result.error]}
+
+def runs():
+    """ Every (mode, batch, frame size, bits, rcvd) combination to
+    benchmark.
+    """
+    for mode in MODES:
+        batches = BATCHES if mode == 'batch' else [0]
+        for batch in batches:
+            for frame_size in FRAME_SIZES:
+                for bits in BITS:
+                    for rcvd in RCVD:
+                        yield mode, batch, frame_size, bits, rcvd == 'on'
+
+def print_run(result):
+    def ms(value):
+        return "-" if value is None else "{:.3f}".format(value)
+    if result['errors']:
+        # the frames that did arrive don't make a meaningful measurement
+        print("{:5} batch={:<5} frame={:<5} bits={:<2} rcvd={:<3} "
+              "FAILED on {} boards: {}".format(
+                  result['mode'], result['batch'] or "-",
+                  result['frame_size'], result['bits'],
+                  "on" if result['rcvd'] else "off", len(result['errors']),
+                  result['errors'][0]))
+        return
+    print("{:5} batch={:<5} frame={:<5} bits={:<2} rcvd={:<3} "
+          "{:>10.0f} frames/s "
+          "{:>8.2f} MB/s  ttff p50/p99/p999 {}/{}/{} ms  "
+          "gap p50/p99/p999 {}/{}/{} ms".format(
+              result['mode'], result['batch'] or "-", result['frame_size'],
+              result['bits'],
+              "on" if result['rcvd'] else "off", result['frames_per_s'],
+              result['mb_per_s'], ms(result['ttff_ms']['p50']),
+              ms(result['ttff_ms']['p99']), ms(result['ttff_ms']['p999']),
+              ms(result['inter_frame_ms']['p50']),
+              ms(result['inter_frame_ms']['p99']),
+              ms(result['inter_frame_ms']['p999'])))
+
+if __name__ == '__main__':
+    for arg in sys.argv[1:]:
+        name, _, value = arg.partition('=')
+        if name == '--server':
+            host, _, port = value.partition(':')
+            SERVER_ADDR = host
+            SERVER_PORT = int(port or SERVER_PORT)
+        elif name == '--boards':
+            BOARDS = int(value)
+        elif name == '--modes':
+            MODES = parse_list(value)
+        elif name == '--batches':
+            BATCHES = parse_list(value, int)
+        elif name == '--frame-sizes':
+            FRAME_SIZES = parse_list(value, int)
+        elif name == '--bits':
+            BITS = parse_list(value, int)
+        elif name == '--endian':
+            ENDIAN = value
+        elif name == '--spectrum':
+            SPECTRUM = value
+        elif name == '--hop':
+            HOP = int(value)
+        elif name == '--fft-window':
+            FFT_WINDOW = value
+        elif name == '--rcvd':
+            RCVD = parse_list(value)
+        elif name == '--window':
+            WINDOW = int(value)
+        elif name == '--persistent':
+            PERSISTENT = True
+        elif name == '--frames':
+            MAX_FRAMES = int(value)
+        elif name == '--song':
+            SONG = value
+        elif name == '--label':
+            LABEL = value
+        elif name == '--output':
+            OUTPUT = value
+        else:
+            print("Skipping invalid argument: " + arg)
+    for mode in MODES:
+        if mode not in STREAM_MODES:
+            sys.exit("Unknown stream mode: " + mode)
+
+    if SONG is None:
+        # the server looks songs up relative to its song directory
+        SONG = os.path.basename(song_list()[0])
+
+    report = {'label': LABEL,
+              'server': "{}:{}".format(SERVER_ADDR, SERVER_PORT),
+              'song': SONG,
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'host': platform.node(),
+              'python': platform.python_version(),
+              'runs': []}
+    for mode, batch, frame_size, bits, rcvd in runs():
+        result = run(SONG, mode, batch, frame_size, bits, rcvd)
+        result['server_stats'] = server_stats()
+        print_run(result)
+        report['runs'].append(result)
+
+    with open(OUTPUT, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to " + OUTPUT)
+    if any(result['errors'] for result in report['runs']):
+        sys.exit("Some runs failed")
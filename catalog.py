@@ -0,0 +1,133 @@
+# This file keeps the index of songs the server can stream. Songs are looked
+# up by path in a dict, their wav headers are read once when they are found,
+# and the SONG_LIST response is encoded once and only rebuilt when a rescan of
+# the song directory finds a change, so control requests stay cheap however
+# many songs there are.
+import os
+import threading
+import time
+import wave
+
+import wav_to_fft
+
+# Minimum number of seconds between two rescans of the song directory.
+RESCAN_INTERVAL = 1.0
+
+class SongInfo(object):
+    """ A song in the catalog and the metadata read from its wav header. """
+    def __init__(self, path, mtime_ns, size):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        with wav_to_fft.WavData(path) as wav_data:
+            self.sample_rate = wav_data.samp_freq
+            self.channels = wav_data.num_channels
+            self.sample_width = wav_data.bytes_per_samp
+            self.num_frames = wav_data.num_frames
+
+    @property
+    def duration(self):
+        """ Length of the song in seconds. """
+        if not self.sample_rate:
+            return 0.0
+        return self.num_frames / self.sample_rate
+
+    def snapshot(self):
+        return {'path': self.path, 'sample_rate': self.sample_rate,
+                'channels': self.channels, 'sample_width': self.sample_width,
+                'frames': self.num_frames, 'duration': self.duration}
+
+class Catalog(object):
+    """ The songs with a given extension in a directory.
+
+    Songs are indexed by their path, i.e. the directory joined with the file
+    name. refresh() rescans the directory at most every rescan_interval
+    seconds, and only when the directory itself was modified, which is the
+    case whenever a song is added, removed or renamed into place.
+    """
+    def __init__(self, directory, extension, rescan_interval=RESCAN_INTERVAL):
+        self.directory = directory
+        self.extension = extension
+        self.rescan_interval = rescan_interval
+        self.songs = {}
+        self.payload = self.encode_song_list()
+        self.directory_mtime_ns = None
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.rescan()
+
+    def __contains__(self, path):
+        return path in self.songs
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __iter__(self):
+        return iter(self.songs)
+
+    def get(self, path):
+        """ Returns the SongInfo of path, or None if it is not a song. """
+        return self.songs.get(path)
+
+    def snapshot(self):
+        """ The metadata of every song, as sent in STATS. """
+        return [song.snapshot() for song in self.songs.values()]
+
+    def refresh(self):
+        """ Rescans the directory if it may have changed since the last scan.
+        Returns True if the catalog changed.
+        """
+        now = time.monotonic()
+        if now - self.checked < self.rescan_interval:
+            return False
+        with self.lock:
+            self.checked = now
+            try:
+                mtime_ns = os.stat(self.directory).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if mtime_ns == self.directory_mtime_ns:
+                return False
+            return self.rescan()
+
+    def rescan(self):
+        """ Lists the directory, reading the header of every new or changed
+        song. Returns True if the catalog changed.
+        """
+        try:
+            self.directory_mtime_ns = os.stat(self.directory).st_mtime_ns
+            entries = sorted(os.scandir(self.directory),
+                             key=lambda entry: entry.name)
+        except OSError:
+            entries = []
+        songs = {}
+        for entry in entries:
+            # START carries song names in ascii
+            if not entry.name.endswith(self.extension) or \
+                    not entry.name.isascii():
+                continue
+            path = os.path.join(self.directory, entry.name)
+            try:
+                st = entry.stat()
+                song = self.songs.get(path)
+                if (song is None or song.mtime_ns != st.st_mtime_ns or
+                        song.size != st.st_size):
+                    song = SongInfo(path, st.st_mtime_ns, st.st_size)
+            except (OSError, wave.Error) as e:
+                print("Skipping {}: {}".format(path, e))
+                continue
+            songs[path] = song
+        changed = (songs.keys() != self.songs.keys() or
+                   any(songs[path] is not self.songs[path] for path in songs))
+        if changed:
+            # built before it is published, readers never see it half done
+            payload = self.encode_song_list(songs)
+            self.songs = songs
+            self.payload = payload
+        return changed
+
+    def encode_song_list(self, songs=None):
+        """ The SONG_LIST response: every path followed by 0x3, then 0x4. """
+        paths = list(songs if songs is not None else self.songs)
+        return "".join(path + "\x03" for path in paths).encode('ascii') + \
+            b"\x04"
@@ -8,8 +8,10 @@ the value to 0xBAADF00D and this value is read back during
 the final connection.
 """
 
+import os
 import socket
 import packets
+import sys
 import time
 
 PACKET = packets.all_packets()
@@ -18,6 +20,54 @@ REQUEST_SIZE = 8192
 BUFFER_SIZE = REQUEST_SIZE*2 + 1
 SERVER_ADDR = '127.0.0.1'
 SERVER_PORT = 9091
+FRAME_SIZE = 1024
+HEADER_SIZE = 4
+LAST_FRAME = b"\xFF\xFF\xFF\xFF"
+
+# --persistent keeps one connection open for the whole song instead of
+# opening one per request
+PERSISTENT = '--persistent' in sys.argv
+# --pipeline=N keeps N NEXT requests in flight on a persistent connection
+PIPELINE = 1
+# --window=N asks the server to keep at most N frames unacknowledged, RCVD
+# then carries the index of the frame received
+WINDOW = 0
+# --resume=N starts the persistent stream at frame N
+RESUME = 0
+# --udp receives the whole song as datagrams, asking for the frames that
+# did not arrive again with NAK
+UDP = '--udp' in sys.argv
+# seconds without a datagram after which the song is taken to be over
+UDP_TIMEOUT = 1.0
+# --pace has the server send the frames in step with the song
+PACE = '--pace' in sys.argv
+for arg in sys.argv:
+    if arg.startswith('--pipeline='):
+        PIPELINE = int(arg.split('=')[1])
+    elif arg.startswith('--window='):
+        WINDOW = int(arg.split('=')[1])
+        PERSISTENT = True
+    elif arg.startswith('--resume='):
+        RESUME = int(arg.split('=')[1])
+        PERSISTENT = True
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+if '--stats' in sys.argv:
+    # print the server's counters and exit
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.connect((SERVER_ADDR, SERVER_PORT))
+        sock.send(PACKET['STATS'])
+        size = int.from_bytes(recv_exact(sock, 4), byteorder='big')
+        print(recv_exact(sock, size).decode('utf-8'))
+    sys.exit(0)
 
 # GET current value
 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
@@ -32,16 +82,112 @@ with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         print(vals[i])
     sock.close()
 
+# the server looks songs up relative to its song directory
+song = os.path.basename(vals[0])
+
+if UDP:
+    start = time.time()
+    received = {}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp, \
+            socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        udp.bind(('0.0.0.0', 0))
+        udp.settimeout(UDP_TIMEOUT)
+        sock.connect((SERVER_ADDR, SERVER_PORT))
+        print("Streaming datagrams from song: " + song)
+        options = {'persist': 1, 'stream': 3, 'udp': udp.getsockname()[1]}
+        if PACE:
+            options['pace'] = 1
+        sock.send(packets.encode_start(song, FRAME_SIZE, options))
+        if sock.recv(1) != PACKET['START_ACK']:
+            print("No START_ACK RECEIVED")
+        sock.send(PACKET['NEXT'])
+        last_frame = None
+        # frames received when the last NAKs were sent
+        asked_at = None
+        while True:
+            try:
+                data = udp.recv(HEADER_SIZE + FRAME_SIZE)
+            except socket.timeout:
+                # the index of the last frame isn't sent, so only the gaps
+                # before the highest index received can be found
+                missing = [i for i in range(max(received, default=-1))
+                           if i not in received]
+                if not missing or asked_at == len(received):
+                    # complete, or the last NAKs brought nothing back
+                    break
+                for i in missing:
+                    udp.sendto(packets.encode_nak(i), (SERVER_ADDR,
+                                                       SERVER_PORT))
+                asked_at = len(received)
+                continue
+            if data[:HEADER_SIZE] == LAST_FRAME:
+                last_frame = data
+            else:
+                index = int.from_bytes(data[:HEADER_SIZE], byteorder='little')
+                received[index] = data
+        sock.send(PACKET['STOP'])
+        sock.recv(1)
+    print("Number of packets: " + str(len(received) + (last_frame is not None)))
+    print("Time elapsed: " + str(time.time() - start))
+    sys.exit(0)
+
+if PERSISTENT:
+    start = time.time()
+    counter = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        print("Streaming frames from song: " + song)
+        # RCVD and NEXT are tiny back to back writes, don't let Nagle hold
+        # NEXT back until RCVD is acknowledged
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect((SERVER_ADDR, SERVER_PORT))
+        options = {'persist': 1}
+        if WINDOW:
+            options['window'] = WINDOW
+        if RESUME:
+            options['resume'] = RESUME
+        if PACE:
+            options['pace'] = 1
+        sock.send(packets.encode_start(song, FRAME_SIZE, options))
+        data = sock.recv(1)
+        if data[0] != PACKET['START_ACK'][0]:
+            print("No START_ACK RECEIVED")
+
+        end_of_song = False
+        sock.send(PACKET['NEXT'] * PIPELINE)
+        while not end_of_song:
+            data = recv_exact(sock, HEADER_SIZE + FRAME_SIZE)
+            counter += 1
+            if WINDOW:
+                ack = packets.encode_rcvd(RESUME + counter - 1)
+            else:
+                ack = PACKET['RCVD']
+            if data[:HEADER_SIZE] == LAST_FRAME or len(data) <= HEADER_SIZE:
+                end_of_song = True
+                sock.send(ack) # acknowledge
+            else:
+                # acknowledge and ask for one more to keep the pipeline full
+                sock.send(ack + PACKET['NEXT'])
+
+        # requests pipelined past the end of the song are answered with ERR
+        sock.send(PACKET['STOP'])
+        while sock.recv(1) not in (PACKET['STOP_ACK'], b""):
+            pass
+
+    end = time.time()
+    print("Number of packets: " + str(counter))
+    print("Time elapsed: " + str(end - start))
+    sys.exit(0)
+
 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
     # request first song
-    print("Requesting a song to start: " + vals[0])
+    print("Requesting a song to start: " + song)
     sock.connect((SERVER_ADDR, SERVER_PORT))
     byte_string = PACKET['START'].decode('ascii')
-    byte_string += vals[0]
+    byte_string += song
     byte_string += "\x03"
-    # want 1024 size frames
-    byte_string += "\x20\x00"
-    sock.send(byte_string.encode('ascii'))
+    sock.send(byte_string.encode('ascii') +
+              FRAME_SIZE.to_bytes(2, byteorder='big')) # want 1024 size frames
 
     # need to receive START_ACK
     data = sock.recv(BUFFER_SIZE)
@@ -55,13 +201,13 @@ counter = 0
 while not end_of_song:
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         # request first song
-        print("Streaming frames from song: " + vals[0])
+        print("Streaming frames from song: " + song)
         sock.connect((SERVER_ADDR, SERVER_PORT))
         sock.send(PACKET['NEXT'])
         data = sock.recv(BUFFER_SIZE)
         counter += 1
     
-        if data[-1] == 0x04:
+        if data[:HEADER_SIZE] == LAST_FRAME or len(data) <= HEADER_SIZE:
             end_of_song = True
         sock.send(PACKET['RCVD']) # acknowledge
 
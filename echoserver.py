@@ -26,21 +26,49 @@ Message Type
 
 0x8 RCVD (from FPGA) 
 
+0xb STATS (JSON snapshot of the server counters)
+
+0xc SEEK (move the stream to a frame index or time offset)
+
+0xd SEEK_ACK (from server, with the frame index moved to)
+
+0xe NAK (frames missing from a datagram stream, over UDP or TCP)
+
+0xf SHEET_RANGE (notes of a range of frames, from the song's MIDI file)
+
+Passing --async serves the same endpoints from an asyncio event loop,
+so that a long stream or song conversion for one board does not hold
+up the others.
+
 """
+import asyncio
+import catalog
+import collections
+import concurrent.futures
 import socket
-import wav_to_fft
+import frames
 import glob
-import struct
 import packets
+import pacing
+import prefetch
+import session
+import sheet
+import stats
 import sys
+import threading
 import time
+import traceback
 import os.path
+import wav_to_fft
+import weakref
 
 PORT = 9091
 BUFFER_SIZE = 1024
 PACKET = packets.all_packets()
 SONG_DIRECTORY = "sample_wav_files"
 FILE_EXT = ".wav"
+MIDI_DIRECTORY = "midi_files"
+MIDI_EXT = ".mid"
 
 DEBUG_ALL = 0
 DEBUG_RCV = DEBUG_ALL | 0
@@ -69,24 +97,157 @@ STREAM_MODE = STRM_SEPARATE
 # RCVD  = 0 - packets are sent out, no need for acknowledgement
 RCVD_ACK = 1
 
-# global song information
-current_song = None
-current_frame_size = 1024
-song_buffer = []
-current_frame = -1
+# START options
+# persist=1  - keep the connection open for the whole song, NEXT, RCVD and STOP
+#              are sent on the same connection as START
+# window=N   - windowed flow control on a persistent connection: RCVD carries
+#              the highest frame index received and at most N frames are in
+#              flight unacknowledged (ignored with --rcvd-off)
+# stream=N   - stream mode for this board (STRM_SEPARATE, STRM_BATCH or
+#              STRM_SONG) instead of STREAM_MODE, so one server can be
+#              benchmarked in every mode
+# bits=LIST  - point widths the board accepts, out of POINT_WIDTHS (12 packs
+#              two points in three bytes). The narrowest one that holds
+#              ffts_actual_bits bits is used, or the widest one listed if
+#              none does, with the FFTs quantized to fit.
+# endian=E   - byte order of the frame headers and points, little or big,
+#              instead of the server's native order
+# spectrum=half - send only the fft_size / 2 + 1 non-redundant bins of a real
+#              FFT, DC to Nyquist, instead of the full mirrored spectrum.
+#              The last frame of each window is padded with zero points
+#              when the bins don't fill it
+# hop=N      - start an FFT every N samples instead of every fft_size, so
+#              windows overlap and frames come at a higher rate
+# fft_window=W - window function applied before each FFT: rect (default),
+#              hann, hamming or blackman
+# channel=C  - channel of a multichannel song to stream: a channel index
+#              (0 by default), mix for a mono downmix, or all for an FFT of
+#              every channel per window, sent one after the other
+# udp=PORT   - send the frames as datagrams to this UDP port of the board
+#              instead of on the TCP connection. Missing frames are asked for
+#              again with NAK.
+# rate=N     - send at most N datagrams per second
+# pace=1     - send each frame when its FFT window starts in the song, i.e.
+#              in step with playback, rather than as soon as it is asked for.
+#              Takes a persistent connection or udp, and overrides rate.
+# sheet=NAME - MIDI file in MIDI_DIRECTORY that SHEET_RANGE sends the notes
+#              of, instead of the one named after the song
+# playlist=LIST - comma separated songs the board is going to play, in
+#              order, so the one after this song can be prefetched
+# resume=N   - start the stream at frame N instead of frame 0, so a board
+#              that reconnects picks up where it left off
+OPT_PERSIST = 'persist'
+OPT_WINDOW = 'window'
+OPT_STREAM = 'stream'
+OPT_BITS = 'bits'
+OPT_ENDIAN = 'endian'
+OPT_SPECTRUM = 'spectrum'
+OPT_HOP = 'hop'
+OPT_FFT_WINDOW = 'fft_window'
+OPT_CHANNEL = 'channel'
+OPT_UDP = 'udp'
+OPT_RATE = 'rate'
+OPT_PACE = 'pace'
+OPT_SHEET = 'sheet'
+OPT_PLAYLIST = 'playlist'
+OPT_RESUME = 'resume'
+POINT_WIDTHS = (8, frames.PACKED_12, 16, 32)
+BYTE_ORDERS = {'little': frames.LITTLE_ENDIAN, 'big': frames.BIG_ENDIAN}
+
+# Datagram transport, see the udp START option. Frames go out from, and NAKs
+# are received on, UDP_PORT. With a rate, a frame that is more than
+# UDP_MAX_LATE seconds behind its schedule is dropped rather than sent late,
+# whether it is due for the first time or asked for again by a NAK.
+UDP_PORT = PORT
+UDP_MAX_DATAGRAM = 65507
+UDP_MAX_LATE = 0.1
+# the UDP socket, or transport with --async, and its NakProtocol
+udp_sender = None
+udp_protocol = None
+
+# sessions streaming over UDP, keyed by the (host, port) their frames go to
+udp_sessions = weakref.WeakValueDictionary()
+
+# sends the frames of every paced session, see the pace START option
+scheduler = pacing.Scheduler()
+
+# play order of the boards and the songs being prefetched, see PREFETCH
+play_order = prefetch.PlayOrder()
+prefetcher = prefetch.Prefetcher()
+
+# CACHE_FRAMES = 1 - packed frames are kept in frame_cache.CACHE_DIRECTORY
+#                    and served from an mmap of the cached file
+CACHE_FRAMES = 1
+
+# PROGRESSIVE = 1 - START_ACK goes out before the song is converted, frames
+#                   are produced in order in the background and NEXT waits
+#                   only if it gets ahead of them
+PROGRESSIVE = 0
+
+# SHARE_BUFFERS = 1 - boards streaming the same song with the same
+#                     parameters share one frame buffer, each with its own
+#                     cursor, instead of loading the song once per board,
+#                     and buffers stay in memory after their last board is
+#                     done, up to BUFFER_CACHE_BYTES
+SHARE_BUFFERS = 1
+
+# Bytes of frame buffers kept in memory for songs no board is streaming,
+# least recently used evicted first. Buffers being streamed are pinned and
+# count towards it, but are never evicted.
+BUFFER_CACHE_BYTES = session.BUFFER_CACHE_BYTES
+
+# PREFETCH = 1 - while a song streams, convert the song the board is likely
+#                to play next into the frame cache, on prefetch.PREFETCH_WORKERS
+#                low priority threads (needs CACHE_FRAMES)
+PREFETCH = 1
+
+# PREWARM = 1 - before listening, convert every song into the frame cache
+#               with frames of PREWARM_FRAME_SIZE bytes, one song per worker
+#               process
+PREWARM = 0
+PREWARM_FRAME_SIZE = 1024
+
+# ASYNC_MODE = 1 - serve connections from an asyncio event loop, converting
+#                  songs on EXECUTOR so they don't block other boards
+ASYNC_MODE = 0
+WORKERS = os.cpu_count()
+EXECUTOR = None
+
+# stream parameters shared by all sessions. Points are padded out to
+# fft_bits bits for boards that don't ask for a width in START.
 fft_bits = 32
-ffts_actual_bits = 16 # need to pad out to 32 bits
+ffts_actual_bits = 16
 fft_size = 1024
 
-def reinit_current_song():
-    global current_song
-    global current_frame_size
-    global song_buffer
-    global current_frame
-    current_song = None
-    current_frame_size = 0
-    song_buffer = []
-    current_frame = -1
+# playback state of every board, keyed by its IP address. Boards open a new
+# connection per request, so the address is what ties requests together.
+sessions = {}
+
+# Seconds after which the session of a board that sent no request and was
+# sent no frame is dropped, along with its hold on a frame buffer. Checked
+# every SESSION_TIMEOUT / 10 seconds as connections come in.
+SESSION_TIMEOUT = 600
+sessions_checked = 0
+
+def get_session(address):
+    expire_sessions()
+    if address not in sessions:
+        sessions[address] = session.Session(address)
+    sess = sessions[address]
+    sess.last_active = time.monotonic()
+    return sess
+
+def expire_sessions():
+    global sessions_checked
+    now = time.monotonic()
+    if now - sessions_checked < SESSION_TIMEOUT / 10:
+        return
+    sessions_checked = now
+    for address, sess in list(sessions.items()):
+        if now - sess.last_active > SESSION_TIMEOUT:
+            debug_printf(DEBUG_ARGS, "Dropping idle session of " + address)
+            del sessions[address]
+            sess.reset()
 
 def debug_printf(debug, string):
     if debug:
@@ -99,94 +260,989 @@ def close_connection(conn, message):
     conn.shutdown(socket.SHUT_RDWR)
     conn.close()
 
-def initialize_song():
-    # get the current song
-    global current_song
-    global current_frame_size
-    global song_buffer
-    global current_frame
-    global fft_bits
-    global fft_size
-    global ffts_actual_bits
-    if current_song:
-        # note that fft_size is the size of the FFT
-        # whereas frame size is the number of bytes packed in each frame
-        # thus, with fft_bits/8 (2bytes per point if fft_bits = 16):
-        #       current_frame_size/(fft_bits/8*fft_size) = number of fft frames per TCP frame
-        # note that the FFT is actually divided in two (symmetrical), so need
-        # to request twice as many points
-        ffts = wav_to_fft.convert_wav_to_fft(current_song, fft_size, ffts_actual_bits)
-        # these need to be byte arrays
-        bytes_per_point = 0
-
-        print(len(ffts[0]))
-
-        # determines number of bytes in each point
-        # and pads as necessary
-        # treat all as unsigned
-
-        if fft_bits <= 8:
-            struct_pack = 'B'
-            bytes_per_point = 1
-        elif fft_bits <= 16:
-            struct_pack = 'H'
-            bytes_per_point = 2
-        elif fft_bits <=32:
-            struct_pack = 'I'
-            bytes_per_point = 4
-        else:
-            struct_pack = 'Q'
-            bytes_per_point = 8
-        
-        print("Current frame size: " + str(current_frame_size))
-        print("Bytes per point: " + str(bytes_per_point))
+def initialize_song(sess):
+    # note that fft_size is the size of the FFT
+    # whereas frame size is the number of bytes packed in each frame
+    # thus, with fft_bits/8 (2bytes per point if fft_bits = 16):
+    #       current_frame_size/(fft_bits/8*fft_size) = number of fft frames per TCP frame
+    # note that the FFT is actually divided in two (symmetrical), so need
+    # to request twice as many points
+    if sess.song:
+        print("Current frame size: " + str(sess.frame_size))
+        print("Bits per point: " + str(frames.point_bits(sess.fft_bits)))
         print("FFT size: " + str(fft_size))
-        tcp_frames_per_fft = int((bytes_per_point*fft_size)/current_frame_size)
+        num_points = wav_to_fft.fft_bins(
+            fft_size, half_spectrum=sess.fft_options.get('half_spectrum'))
+        tcp_frames_per_fft = frames.frames_per_fft(sess.fft_bits,
+                                                   sess.frame_size, num_points)
         print("FFT frames/TCP: " + str(tcp_frames_per_fft))
-        i = 0
-        # over all ffts
-        song_buffer=[]
-
-        while i < len(ffts):
-            # need to consume ${fft_frames_per_tcp} in a single TCP frame
-            for j in range(tcp_frames_per_fft):
-                ba = b""
-                so_far = j*int(current_frame_size/bytes_per_point)
-                for k in range(so_far, so_far + int(current_frame_size/bytes_per_point)):
-                    a = struct.pack(struct_pack, int(ffts[i][k]))
-                    ba += a
-
-                # move to next frame
-                song_buffer.append(ba)
-            i=i+1
-                
+        sess.frames_per_fft = tcp_frames_per_fft
 
+        if PREFETCH:
+            # the song may be the one being prefetched
+            prefetcher.wait(sess.song, sess.frame_size, fft_size,
+                            sess.ffts_actual_bits, sess.fft_bits,
+                            sess.byte_order, sess.fft_options)
+        if PROGRESSIVE:
+            load_song = session.load_song_progressive
+        else:
+            load_song = session.load_song
+        lease = None
+        if SHARE_BUFFERS:
+            # the new buffer is pinned before the old one is released, so
+            # a START for the same song finds it in the cache
+            lease = buffer_cache.acquire(
+                load_song, sess.song, sess.frame_size, fft_size,
+                sess.ffts_actual_bits, sess.fft_bits, CACHE_FRAMES,
+                sess.byte_order, sess.fft_options)
+            song_buffer = lease.buffer
+        else:
+            sess.release_buffer()
+            song_buffer = load_song(sess.song, sess.frame_size, fft_size,
+                                    sess.ffts_actual_bits, sess.fft_bits,
+                                    CACHE_FRAMES, sess.byte_order,
+                                    sess.fft_options)
         print(len(song_buffer))
-        # pad last with 0s
-#        for i in range(len(song_buffer[0]) -  len(song_buffer[-1])):
-#            song_buffer[-1] += b"\x00"
-        current_frame = 0
+        with sess.lock:
+            # paced frames of the last song stop before its buffer goes
+            sess.stop_pacing()
+            sess.release_buffer()
+            sess.buffer_lease = lease
+            sess.song_buffer = song_buffer
+            sess.current_frame = 0
+            sess.target = 0
+            sess.acked = 0
+            sess.udp_sent = 0
     else:
         debug_printf(DEBUG_ALL, "No song selected - cannot initialize song")
 
-# all songs in system
-# songs = glob.glob(SONG_DIRECTORY + "/" + FILE_EXT)
-songs = []
-for file in os.listdir(SONG_DIRECTORY):
-    if file.endswith(FILE_EXT):
-        songs.append(os.path.join(SONG_DIRECTORY, file))
+def song_list_payload():
+    # prebuilt by the catalog, rebuilt only when the song directory changes
+    songs.refresh()
+    return songs.payload
+
+def find_song(song_name):
+    # a song that was just added shows up after a rescan
+    if song_name not in songs:
+        songs.refresh()
+    return songs.get(song_name)
+
+def parse_start(data):
+    # receiving a song name, ending with 0x3, with 2bytes following
+    # forming the size of the frame for this stream
+    song_name_actual, frame_size, options = packets.parse_start(data)
+    return os.path.join(SONG_DIRECTORY, song_name_actual), frame_size, options
+
+def stream_format(options):
+    """ Negotiates (fft_bits, ffts_actual_bits, byte_order) for a START
+    with the given options.
+    """
+    accepted = [int(bits) for bits in options.get(OPT_BITS, "").split(',')
+                if bits.isdigit() and int(bits) in POINT_WIDTHS]
+    if accepted:
+        holding = [bits for bits in accepted if bits >= ffts_actual_bits]
+        bits = min(holding) if holding else max(accepted)
+    else:
+        bits = fft_bits
+    byte_order = BYTE_ORDERS.get(options.get(OPT_ENDIAN), frames.NATIVE)
+    return bits, min(ffts_actual_bits, bits), byte_order
+
+def fft_options(options):
+    # arguments of the FFT stage asked for in START, see session.load_song
+    fft_options = {}
+    if options.get(OPT_SPECTRUM) == 'half':
+        fft_options['half_spectrum'] = True
+    hop = options.get(OPT_HOP, "")
+    if hop.isdigit() and 0 < int(hop) != fft_size:
+        fft_options['hop'] = int(hop)
+    window = options.get(OPT_FFT_WINDOW, 'rect')
+    if window != 'rect' and window in wav_to_fft.WINDOW_FUNCTIONS:
+        fft_options['window'] = window
+    channel = options.get(OPT_CHANNEL, "")
+    if channel in (wav_to_fft.CHANNELS_MIX, wav_to_fft.CHANNELS_ALL):
+        fft_options['channels'] = channel
+    elif channel.isdigit() and int(channel) != 0:
+        fft_options['channels'] = int(channel)
+    return fft_options
+
+def resume_stream(sess, options):
+    # START with resume=N puts the cursor on frame N once the song is
+    # loaded. Returns False if N is past the end of the song.
+    resume = options.get(OPT_RESUME, "")
+    if not resume.isdigit() or int(resume) == 0:
+        return True
+    return sess.seek(int(resume))
+
+def open_udp(sess, options):
+    # START with udp=PORT streams to that port of the board's address.
+    # Returns False if the frames don't fit in a datagram.
+    rate = options.get(OPT_RATE, "")
+    sess.rate = int(rate) if rate.isdigit() else 0
+    sess.udp_address = None
+    port = options.get(OPT_UDP, "")
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        return True
+    record_size = frames.HEADER_SIZE + frames.frame_bytes(sess.fft_bits,
+                                                          sess.frame_size)
+    if record_size > UDP_MAX_DATAGRAM:
+        return False
+    sess.udp_address = (sess.address, int(port))
+    udp_sessions[sess.udp_address] = sess
+    return True
+
+def sheet_path(song_name, options):
+    # the MIDI file named in START, or the one named after the song
+    name = options.get(OPT_SHEET) or \
+        os.path.splitext(os.path.basename(song_name))[0] + MIDI_EXT
+    path = os.path.join(MIDI_DIRECTORY, os.path.basename(name))
+    if os.path.isfile(path):
+        return path
+    return None
+
+def sheet_payload(sess, data):
+    # the notes of frames [first, stop) of the stream. Every frame of an FFT
+    # window shows the same moment of the song, so a note goes with the
+    # first frame of the window it falls in.
+    frames_per_window = sess.ffts_per_window * sess.frames_per_fft
+    if (sess.current_frame == -1 or sess.sheet is None or
+            not frames_per_window or not sess.sample_rate):
+        debug_printf(DEBUG_RCV, "Asked for sheet music with no stream or MIDI file")
+        return PACKET['ERR']
+    try:
+        song_sheet = sheet.load(sess.sheet)
+    except (OSError, sheet.MidiError) as e:
+        print("Can't read sheet music {}: {}".format(sess.sheet, e))
+        return PACKET['ERR']
+    first, stop = packets.parse_sheet(data)
+    # the MIDI file may run past the end of the song
+    stop = min(stop, len(sess.song_buffer))
+    hop = sess.fft_options.get('hop', fft_size)
+    events, windows = song_sheet.windows(-(-first // frames_per_window),
+                                         -(-stop // frames_per_window),
+                                         sess.sample_rate, hop)
+    stats.incr('sheet_events', len(events))
+    return sheet.encode_events(events, windows * frames_per_window,
+                               sess.byte_order)
+
+def prefetch_next(sess, options):
+    # learn the board's play order, then start converting the song it will
+    # likely ask for next while this one streams
+    playlist = [os.path.join(SONG_DIRECTORY, name)
+                for name in options.get(OPT_PLAYLIST, "").split(',') if name]
+    play_order.record(sess.address, sess.song, playlist)
+    if not PREFETCH or not CACHE_FRAMES:
+        return
+    song = play_order.predict(sess.address, sess.song, songs)
+    if song is None or find_song(song) is None:
+        return
+    debug_printf(DEBUG_ARGS, "Prefetching: " + song)
+    prefetcher.submit(song, sess.frame_size, fft_size, sess.ffts_actual_bits,
+                      sess.fft_bits, sess.byte_order, sess.fft_options)
+
+def start_stream(sess, data):
+    # opens the song asked for in START: validates the options, converts the
+    # song to frames and puts the cursor on its first frame. Returns the
+    # reply to the START.
+    sess.start_time = time.perf_counter()
+
+    # split the song from it
+    song_name, frame_size, options = parse_start(data)
+    debug_printf(DEBUG_RCV, "Song stripped: " + str(song_name))
+    song_info = find_song(song_name)
+    if song_info is None:
+        # send back error - song doesnt exist
+        debug_printf(DEBUG_ARGS, "Song not found. Received: " + song_name)
+        return PACKET['ERR']
+    song_fft_options = fft_options(options)
+    ffts_per_window = wav_to_fft.channel_ffts(
+        song_info.channels, song_fft_options.get('channels', 0))
+    if not ffts_per_window:
+        debug_printf(DEBUG_ARGS, "Song has no such channel")
+        return PACKET['ERR']
+    if stream_option(options) is None:
+        debug_printf(DEBUG_ARGS, "No such stream mode")
+        return PACKET['ERR']
+
+    fft_bits, actual_bits, byte_order = stream_format(options)
+    num_points = wav_to_fft.fft_bins(
+        fft_size, half_spectrum=song_fft_options.get('half_spectrum'))
+    if not frames.frames_per_fft(fft_bits, frame_size, num_points):
+        debug_printf(DEBUG_ARGS, "Frame size smaller than a point")
+        return PACKET['ERR']
+
+    sess.song = song_name
+    sess.sample_rate = song_info.sample_rate
+    sess.ffts_per_window = ffts_per_window
+    sess.frame_size = frame_size
+    sess.fft_bits, sess.ffts_actual_bits, sess.byte_order = \
+        fft_bits, actual_bits, byte_order
+    sess.fft_options = song_fft_options
+    if not open_udp(sess, options):
+        debug_printf(DEBUG_ARGS, "Frames too large for a datagram")
+        sess.reset()
+        return PACKET['ERR']
+    sess.paced = options.get(OPT_PACE, '0') != '0'
+    sess.sheet = sheet_path(song_name, options)
+    #initializes the song
+    # opens file, converts to FFT, stores frames, and
+    # puts cursor in start position
+    debug_printf(DEBUG_ARGS, "Frame size: " + str(sess.frame_size))
+    debug_printf(DEBUG_ARGS, "Requested song: " + sess.song)
+    initialize_song(sess)
+    if not len(sess.song_buffer):
+        # a NEXT would have no frame to get
+        debug_printf(DEBUG_ARGS, "Song shorter than an FFT window")
+        sess.reset()
+        return PACKET['ERR']
+    if not resume_stream(sess, options):
+        debug_printf(DEBUG_ARGS, "Resume frame beyond stream end")
+        sess.reset()
+        return PACKET['ERR']
+    stats.observe('start', int((time.perf_counter() - sess.start_time) * 1e9))
+    prefetch_next(sess, options)
+    return PACKET['START_ACK']
+
+def time_to_frame(sess, milliseconds):
+    # window i starts at sample i * hop, and its FFTs are split into
+    # frames_per_fft consecutive frames each
+    hop = sess.fft_options.get('hop', fft_size)
+    window = milliseconds * sess.sample_rate // (1000 * hop)
+    return window * sess.ffts_per_window * sess.frames_per_fft
+
+def seek_stream(sess, data):
+    # frames are fixed size records, so moving the cursor is all a seek
+    # takes wherever it lands. Returns the reply to the SEEK.
+    try:
+        unit, position = packets.parse_seek(data)
+    except packets.ProtocolError as e:
+        debug_printf(DEBUG_RCV, "BAD COMMAND SENT: " + str(e))
+        return PACKET['BAD_MESSAGE']
+    if unit == packets.SEEK_TIME:
+        position = time_to_frame(sess, position)
+    if not sess.seek(position):
+        debug_printf(DEBUG_RCV, "Asked to seek to frame " + str(position) + " with no stream open or beyond stream end")
+        return PACKET['ERR']
+    stats.incr('seeks')
+    return packets.encode_seek_ack(position)
+
+def connection_session(sess, data, address):
+    # a START asking for a persistent connection gets a session of its own,
+    # tied to the connection rather than to the board's address
+    if data[0] == PACKET['START'][0]:
+        options = parse_start(data)[2]
+        window = options.get(OPT_WINDOW, '0')
+        if not window.isdigit():
+            raise packets.ProtocolError("bad window in START: " + window)
+        window = int(window)
+        if options.get(OPT_PERSIST, '0') != '0' or window:
+            # the session this one replaces is done with its song, and a
+            # persistent one on this connection hands over its writer
+            sess.reset()
+            writer = sess.writer if sess.persistent else None
+            sess = session.Session(address)
+            sess.persistent = True
+            sess.writer = writer
+        if window:
+            # RCVDs carry frame indexes whether or not we enforce the window
+            sess.rcvd_size = packets.RCVD_INDEX_SIZE
+            if RCVD_ACK:
+                sess.window = window
+        mode = stream_option(options)
+        if mode:
+            sess.stream_mode = mode
+    return sess
+
+def stream_option(options):
+    # stream mode asked for in START, 0 for the server's default and None
+    # for anything that isn't a stream mode
+    mode = options.get(OPT_STREAM, '0')
+    if not mode.isdigit():
+        return None
+    mode = int(mode)
+    if mode != 0 and not STRM_SEPARATE <= mode <= STRM_SONG:
+        return None
+    return mode
+
+def stream_mode(sess):
+    return sess.stream_mode or STREAM_MODE
+
+def next_size(sess):
+    # in batch mode NEXT is followed by the number of frames to stream
+    if stream_mode(sess) == STRM_BATCH:
+        return 3
+    return 1
+
+def new_decoder(sess):
+    return packets.MessageDecoder(next_size=next_size(sess))
+
+def end_request(conn, sess, message):
+    # old firmware opens a new connection for every request, persistent
+    # sessions keep theirs until STOP. Returns True if conn was closed.
+    if sess.persistent:
+        if message != None:
+            with sess.lock:
+                # behind any paced frames still on their way
+                flush_writes(sess)
+                conn.send(message)
+        return False
+    close_connection(conn, message)
+    return True
+
+def request_frames(sess, data):
+    # NEXT asks for more frames on top of any still waiting to be sent
+    with sess.lock:
+        num_to_follow = frames_to_follow(sess, data)
+        sess.target = max(sess.target, sess.current_frame) + num_to_follow
+
+def frames_to_follow(sess, data):
+    # streams it in batch mode - expects a number of requests to follow
+    num_to_follow = 0
+    mode = stream_mode(sess)
+    if mode == STRM_BATCH:
+        num_to_follow = int.from_bytes(data[-2:], byteorder='big')
+        if num_to_follow > sess.frames_left():
+            num_to_follow = sess.frames_left() # limit near end of song
+    elif mode == STRM_SEPARATE:
+        num_to_follow = 1
+    elif mode == STRM_SONG:
+        num_to_follow = sess.frames_left() # rest of song
+    return num_to_follow
+
+# batches smaller than this are written from the mapping rather than with
+# sendfile, whose setup costs more than copying a few frames
+SENDFILE_MIN_BYTES = 65536
+
+def send_frames(conn, song_buffer, start, stop):
+    # the records of consecutive frames are contiguous, so a batch goes out
+    # as one sendfile from the cached file, or one sendall over the buffer.
+    # Both keep writing until the socket has taken every byte. A song that
+    # is still being converted is sent as its frames become ready.
+    while start < stop:
+        ready = min(song_buffer.wait_for(start), stop)
+        offset = song_buffer.offset(start)
+        count = song_buffer.offset(ready) - offset
+        if song_buffer.file is not None and count >= SENDFILE_MIN_BYTES:
+            conn.sendfile(song_buffer.file, offset, count)
+        else:
+            conn.sendall(song_buffer.records(start, ready))
+        start = ready
+
+async def async_send_frames(writer, song_buffer, start, stop):
+    loop = asyncio.get_running_loop()
+    while start < stop:
+        ready = song_buffer.ready
+        if ready <= start:
+            # don't hold up the event loop waiting for the producer
+            ready = await asyncio.to_thread(song_buffer.wait_for, start)
+        ready = min(ready, stop)
+        offset = song_buffer.offset(start)
+        count = song_buffer.offset(ready) - offset
+        if song_buffer.file is not None and count >= SENDFILE_MIN_BYTES:
+            await loop.sendfile(writer.transport, song_buffer.file, offset,
+                                count)
+        else:
+            writer.write(song_buffer.records(start, ready))
+            await writer.drain()
+        start = ready
+
+def send_datagrams(sess, start, stop):
+    # one datagram per frame, as fast as they are converted. Sessions with
+    # a rate are sent theirs by the scheduler, see rate_limit
+    for index in range(start, stop):
+        sess.song_buffer.wait_for(index)
+        sess.udp_sent = index + 1
+        udp_sender.sendto(sess.song_buffer.record(index), sess.udp_address)
+
+async def async_send_datagrams(sess, start, stop):
+    for index in range(start, stop):
+        if sess.song_buffer.ready <= index:
+            await asyncio.to_thread(sess.song_buffer.wait_for, index)
+        sess.udp_sent = index + 1
+        # the transport would buffer the whole song otherwise
+        await udp_protocol.writable.wait()
+        udp_sender.sendto(sess.song_buffer.record(index), sess.udp_address)
+
+def retransmit(sess, data):
+    # resend the frames a NAK reports missing, from the packed buffer. Frames
+    # not sent yet are left to their turn, and frames that would now arrive
+    # too late to be shown are dropped.
+    # NAKs on the UDP socket are handled on their own thread, so this only
+    # reads the session once and never past the end of its buffer
+    song_buffer, address = sess.song_buffer, sess.udp_address
+    if address is None:
+        return
+    first, count = packets.parse_nak(data)
+    stop = min(first + count, sess.udp_sent, len(song_buffer))
+    for index in range(first, stop):
+        # how far behind the frame going out now it would arrive
+        behind = (sess.udp_sent - index) / sess.rate if sess.rate else 0
+        if behind > UDP_MAX_LATE:
+            stats.incr('udp_late_drops')
+            continue
+        udp_sender.sendto(song_buffer.record(index), address)
+        stats.incr('udp_retransmits')
+
+def receive_nak(data, address):
+    # a NAK on the UDP socket comes from the port the frames go to
+    sess = udp_sessions.get(address)
+    if (sess is None or len(data) != packets.NAK_SIZE or
+            data[0] != PACKET['NAK'][0]):
+        return
+    retransmit(sess, data)
+
+def serve_naks(sock):
+    while True:
+        data, address = sock.recvfrom(BUFFER_SIZE)
+        receive_nak(data, address)
+
+class NakProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def datagram_received(self, data, address):
+        receive_nak(data, address)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+def paced(sess):
+    # frames sent later than NEXT need a connection or a UDP port to go to
+    return (sess.paced and sess.sample_rate and
+            (sess.persistent or sess.udp_address is not None))
+
+def pace(sess, send, writable=None):
+    # hand the session to the scheduler, which calls send(stream, first,
+    # stop) as frames fall due: every FFT window hop samples after the last
+    if sess.pacer is None:
+        hop = sess.fft_options.get('hop', fft_size)
+        sess.pacer = pacing.PacedStream(
+            sess, hop / sess.sample_rate,
+            sess.ffts_per_window * sess.frames_per_fft, send, writable)
+    scheduler.wake(sess.pacer)
+
+class ConnectionWriter(object):
+    """ Writes paced frames to a connection of the blocking server without
+    blocking the scheduler thread.
+
+    What the socket doesn't take right away is kept, in order, and sent by
+    drain() on the following ticks; the stream sends no new frames until
+    it is all gone. The connection's own thread calls flush() under the
+    session's lock before it writes a reply, so replies never land in the
+    middle of a frame.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.pending = collections.deque()
+        # frames go out when they fall due, not when the last ones are
+        # acknowledged
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def write(self, data):
+        self.pending.append(memoryview(data))
+        self.drain()
+
+    def drain(self):
+        """ Sends what the socket takes without blocking. Returns True once
+        nothing is left.
+        """
+        while self.pending:
+            try:
+                sent = self.conn.send(self.pending[0], socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return False
+            if sent < len(self.pending[0]):
+                self.pending[0] = self.pending[0][sent:]
+            else:
+                self.pending.popleft()
+        return True
+
+    def flush(self):
+        while self.pending:
+            self.conn.sendall(self.pending.popleft())
+
+def flush_writes(sess):
+    # paced frames not sent yet go out before anything else is written
+    if sess.writer is not None:
+        sess.writer.flush()
+
+def paced_frames(writer):
+    # writer is a ConnectionWriter, or the StreamWriter of an asyncio
+    # connection. The frames come from song_buffer if given, see loop_send
+    def send(stream, first, stop, song_buffer=None):
+        if song_buffer is None:
+            song_buffer = stream.sess.song_buffer
+        start = time.perf_counter_ns()
+        writer.write(song_buffer.records(first, stop))
+        count_sent(stream.sess, first, stop, time.perf_counter_ns() - start,
+                   song_buffer)
+    return send
+
+def paced_datagrams(stream, first, stop, song_buffer=None):
+    # frames further behind their deadline than UDP_MAX_LATE are dropped
+    sess = stream.sess
+    if song_buffer is None:
+        song_buffer = sess.song_buffer
+    start = time.perf_counter_ns()
+    now = time.monotonic()
+    for index in range(first, stop):
+        if now - stream.deadline(index) > UDP_MAX_LATE:
+            stats.incr('udp_late_drops')
+            continue
+        udp_sender.sendto(song_buffer.record(index), sess.udp_address)
+    sess.udp_sent = stop
+    count_sent(sess, first, stop, time.perf_counter_ns() - start,
+               song_buffer)
+
+def loop_send(loop, send):
+    # the asyncio transports are only used from the event loop, so the
+    # scheduler thread hands the frames it sends over to it. The buffer is
+    # taken while the tick holds the session: by the time the loop gets to
+    # them, a STOP or a new START may have reset it, and frames of a
+    # stopped stream aren't sent at all
+    def queue(stream, first, stop):
+        song_buffer = stream.sess.song_buffer
+        def callback():
+            if not stream.cancelled:
+                send(stream, first, stop, song_buffer)
+        loop.call_soon_threadsafe(callback)
+    return queue
+
+def rate_limit(sess, send=paced_datagrams):
+    # sleeping between datagrams would hold up the connection, and the
+    # whole blocking server, for the length of the song, so the scheduler
+    # thread sends a frame every 1 / rate seconds instead. The schedule
+    # starts over from a NEXT that finds the previous frames all sent
+    with sess.lock:
+        if sess.pacer is None:
+            sess.pacer = pacing.PacedStream(sess, 1 / sess.rate, 1, send)
+        elif not sess.pacer.scheduled:
+            sess.pacer.anchor(sess.current_frame)
+    scheduler.wake(sess.pacer)
+
+def stream_frames(conn, sess):
+    if paced(sess):
+        if sess.udp_address is not None:
+            pace(sess, paced_datagrams)
+        else:
+            if sess.writer is None:
+                sess.writer = ConnectionWriter(conn)
+            pace(sess, paced_frames(sess.writer), sess.writer.drain)
+        return
+    if sess.udp_address is not None and sess.rate:
+        rate_limit(sess)
+        return
+    # send what the board asked for, as far as its window allows
+    with sess.lock:
+        stop = sess.send_limit()
+        if stop > sess.current_frame:
+            first = sess.current_frame
+            sess.current_frame = stop
+            debug_printf(DEBUG_RCV, "Sending frames " + str(first) + " to " + str(stop - 1) + " of " + str(len(sess.song_buffer)))
+            start = time.perf_counter_ns()
+            if sess.udp_address is not None:
+                send_datagrams(sess, first, stop)
+            else:
+                flush_writes(sess)
+                send_frames(conn, sess.song_buffer, first, stop)
+            count_sent(sess, first, stop, time.perf_counter_ns() - start)
+
+async def async_stream_frames(writer, sess):
+    if paced(sess):
+        loop = asyncio.get_running_loop()
+        if sess.udp_address is not None:
+            send = paced_datagrams
+        else:
+            send = paced_frames(writer)
+        pace(sess, loop_send(loop, send))
+        return
+    if sess.udp_address is not None and sess.rate:
+        rate_limit(sess, loop_send(asyncio.get_running_loop(),
+                                   paced_datagrams))
+        return
+    stop = sess.send_limit()
+    if stop > sess.current_frame:
+        first = sess.current_frame
+        sess.current_frame = stop
+        start = time.perf_counter_ns()
+        if sess.udp_address is not None:
+            await async_send_datagrams(sess, first, stop)
+        else:
+            await async_send_frames(writer, sess.song_buffer, first, stop)
+        count_sent(sess, first, stop, time.perf_counter_ns() - start)
+
+def count_sent(sess, first, stop, elapsed, song_buffer=None):
+    # song_buffer is the buffer the frames were sent from, if the session
+    # may have moved on to another one since
+    if song_buffer is None:
+        song_buffer = sess.song_buffer
+    num_bytes = song_buffer.offset(stop) - song_buffer.offset(first)
+    sess.frames_sent += stop - first
+    sess.bytes_sent += num_bytes
+    stats.incr('frames_sent', stop - first)
+    stats.incr('bytes_sent', num_bytes)
+    # time per frame, averaged over the batch
+    stats.observe('frame_send', elapsed // (stop - first))
+    sess.last_active = time.monotonic()
+    if stop == len(song_buffer):
+        print_download_time(sess)
+        with sess.lock:
+            if sess.song_buffer is song_buffer:
+                # NAKs and SEEKs that come after this get nothing, the
+                # board STARTs the song again to replay it
+                sess.finish()
+
+def receive_ack(sess, data):
+    # a RCVD on a connection-per-request session moves the cursor, on a
+    # persistent one it only acknowledges what NEXT already sent
+    if sess.rcvd_size == packets.RCVD_INDEX_SIZE:
+        sess.acknowledge(packets.parse_rcvd(data))
+    elif not sess.persistent:
+        with sess.lock:
+            if sess.current_frame != -1:
+                sess.current_frame += 1 # increase frame counter
+
+def stats_payload():
+    snapshot = stats.snapshot()
+    snapshot['songs'] = songs.snapshot()
+    snapshot['buffer_cache'] = buffer_cache.snapshot()
+    snapshot['sessions'] = [s.snapshot() for s in list(session.live_sessions)
+                            if s.song is not None]
+    return stats.encode(snapshot)
+
+def print_download_time(sess):
+    end = time.perf_counter()
+    stats.observe('song_download', int((end - sess.start_time) * 1e9))
+    print("Time to download song: " + str(end - sess.start_time))
+
+def prewarm(frame_size):
+    print("Prewarming " + str(len(songs)) + " songs")
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        futures = {}
+        for song in songs:
+            future = pool.submit(session.prewarm_song, song, frame_size,
+                                 fft_size, ffts_actual_bits, fft_bits)
+            futures[future] = song
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            done += 1
+            try:
+                song, elapsed = future.result()
+                print("Prewarmed {}/{}: {} ({:.2f}s)".format(
+                    done, len(futures), song, elapsed))
+            except Exception as e:
+                print("Prewarm failed {}/{}: {} ({})".format(
+                    done, len(futures), futures[future], e))
+    print("Prewarm finished in {:.2f}s".format(time.perf_counter() - start))
+
+async def async_song_list(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting song list")
+    writer.write(song_list_payload())
+
+async def async_sheet(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting sheet music")
+
+async def async_sheet_range(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting sheet music of frames")
+    writer.write(sheet_payload(sess, data))
+
+async def async_start(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting start of stream")
+    # the FFT is CPU bound, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    writer.write(await loop.run_in_executor(EXECUTOR, start_stream, sess,
+                                            data))
+
+async def async_next(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting next frame")
+    if sess.current_frame == -1:
+        # stream is not open
+        debug_printf(DEBUG_RCV, "Asked for frame with no stream open")
+        writer.write(PACKET['ERR'])
+        return
+    elif sess.current_frame == len(sess.song_buffer):
+        # cannot request
+        debug_printf(DEBUG_RCV, "Asked for frame beyond stream end")
+        sess.reset()
+        writer.write(PACKET['ERR'])
+        return
+
+    request_frames(sess, data)
+    await async_stream_frames(writer, sess)
+
+async def async_stop(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting stop frame")
+    sess.reset()
+    writer.write(PACKET['STOP_ACK'])
+
+async def async_seek(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting seek")
+    writer.write(seek_stream(sess, data))
+
+async def async_nak(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting retransmit")
+    if sess.udp_address is not None:
+        retransmit(sess, data)
+
+async def async_rcvd(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Receive frame ACK")
+    receive_ack(sess, data)
+    if sess.persistent:
+        # the acknowledgement may have opened the window
+        await async_stream_frames(writer, sess)
+
+async def async_stats(sess, data, writer):
+    debug_printf(DEBUG_RCV, "Requesting stats")
+    writer.write(stats_payload())
+
+async def async_bad_message(sess, data, writer):
+    debug_printf(DEBUG_RCV, "BAD COMMAND SENT")
+    writer.write(PACKET['BAD_MESSAGE'])
+
+ASYNC_HANDLERS = {
+    PACKET['SONG_LIST'][0]: async_song_list,
+    PACKET['SHEET'][0]: async_sheet,
+    PACKET['SHEET_RANGE'][0]: async_sheet_range,
+    PACKET['START'][0]: async_start,
+    PACKET['NEXT'][0]: async_next,
+    PACKET['STOP'][0]: async_stop,
+    PACKET['RCVD'][0]: async_rcvd,
+    PACKET['STATS'][0]: async_stats,
+    PACKET['SEEK'][0]: async_seek,
+    PACKET['NAK'][0]: async_nak,
+}
+
+async def handle_client(reader, writer):
+    address = writer.get_extra_info('peername')[0]
+    stats.mark('connections')
+    sess = get_session(address)
+    try:
+        decoder = new_decoder(sess)
+        while True:
+            data = decoder.next_message()
+            if data is None:
+                chunk = await reader.read(BUFFER_SIZE)
+                debug_printf(DEBUG_RCV, "Received: " + str(chunk))
+                if not chunk:
+                    break
+                decoder.feed(chunk)
+                continue
+            sess = connection_session(sess, data, address)
+            decoder.rcvd_size = sess.rcvd_size
+            decoder.next_size = next_size(sess)
+            handler = ASYNC_HANDLERS.get(data[0], async_bad_message)
+            await handler(sess, data, writer)
+            await writer.drain()
+            # one request per connection unless the session is persistent
+            if not sess.persistent or data[0] == PACKET['STOP'][0]:
+                break
+    except packets.ProtocolError as e:
+        debug_printf(DEBUG_RCV, "BAD COMMAND SENT: " + str(e))
+        writer.write(PACKET['BAD_MESSAGE'])
+    except ConnectionError as e:
+        debug_printf(DEBUG_RCV, "Connection lost: " + str(e))
+    except Exception:
+        print("Error serving " + address + ":")
+        traceback.print_exc()
+    finally:
+        if sess.persistent:
+            # paced frames would have nowhere to go
+            sess.stop_pacing()
+        writer.close()
+
+async def serve_async():
+    global udp_sender, udp_protocol
+    server = await asyncio.start_server(handle_client, '0.0.0.0', PORT,
+                                        backlog=100, reuse_address=True)
+    loop = asyncio.get_running_loop()
+    udp_sender, udp_protocol = await loop.create_datagram_endpoint(
+        NakProtocol, local_addr=('0.0.0.0', UDP_PORT))
+    print("BEGIN LISTENING ON PORT", PORT)
+    async with server:
+        await server.serve_forever()
+
+def serve_connection(conn, address, sess=None, decoder=None, pending=None):
+    """ Serves the requests of one connection of the blocking server.
+
+    Connections that carry a single request are served on the accept loop.
+    A connection that turns persistent is handed to a thread of its own,
+    which carries on from the message that made it persistent (pending),
+    so a board streaming a song doesn't hold up the other boards.
+    """
+    threaded = sess is not None
+    if sess is None:
+        sess = get_session(address)
+        decoder = new_decoder(sess)
+    handed_off = False
+    try:
+        while(True):
+            try:
+                if pending is not None:
+                    data, pending = pending, None
+                else:
+                    data = decoder.next_message()
+                    if data is not None:
+                        sess = connection_session(sess, data, address)
+                        decoder.rcvd_size = sess.rcvd_size
+                        decoder.next_size = next_size(sess)
+                        if sess.persistent and not threaded:
+                            # the board keeps the connection until STOP,
+                            # serve it without holding up everyone else
+                            threading.Thread(
+                                target=serve_connection,
+                                args=(conn, address, sess, decoder, data),
+                                daemon=True).start()
+                            handed_off = True
+                            return
+            except packets.ProtocolError as e:
+                debug_printf(DEBUG_RCV, "BAD COMMAND SENT: " + str(e))
+                with sess.lock:
+                    flush_writes(sess)
+                    close_connection(conn, PACKET['BAD_MESSAGE'])
+                break
+            if data is None:
+                chunk = conn.recv(BUFFER_SIZE)
+                debug_printf(DEBUG_RCV, "Received: " + str(chunk))
+                if not chunk:
+                    break
+                decoder.feed(chunk)
+                continue
+            if data[0] == PACKET['SONG_LIST'][0]:
+                debug_printf(DEBUG_RCV, "Requesting song list")
+                if end_request(conn, sess, song_list_payload()):
+                    break
+            elif data[0] == PACKET['SHEET'][0]:
+                debug_printf(DEBUG_RCV, "Requesting sheet music")
+                # the one byte SHEET of older boards gets no reply
+                if end_request(conn, sess, None):
+                    break
+            elif data[0] == PACKET['SHEET_RANGE'][0]:
+                debug_printf(DEBUG_RCV, "Requesting sheet music of frames")
+                if end_request(conn, sess, sheet_payload(sess, data)):
+                    break
+            elif data[0] == PACKET['START'][0]:
+                debug_printf(DEBUG_RCV, "Requesting start of stream")
+                if end_request(conn, sess, start_stream(sess, data)):
+                    break
+            elif data[0] == PACKET['NEXT'][0]:
+                debug_printf(DEBUG_RCV, "Requesting next frame")
+                if sess.current_frame == -1:
+                    # stream is not open
+                    debug_printf(DEBUG_RCV, "Asked for frame with no stream open")
+                    if end_request(conn, sess, PACKET['ERR']):
+                        break
+                    continue
+                elif sess.current_frame == len(sess.song_buffer):
+                    # cannot request
+                    debug_printf(DEBUG_RCV, "Asked for frame beyond stream end")
+                    sess.reset()
+                    if end_request(conn, sess, PACKET['ERR']):
+                        break
+                    continue
+
+                request_frames(sess, data)
+                stream_frames(conn, sess)
+
+                # reached the end time to leave
+                #sess.reset()
+                if end_request(conn, sess, None):
+                    break
+
+            elif data[0] == PACKET['STOP'][0]:
+                debug_printf(DEBUG_RCV, "Requesting stop frame")
+                with sess.lock:
+                    sess.reset()
+                    flush_writes(sess)
+                    close_connection(conn, PACKET['STOP_ACK'])
+                break
+            elif data[0] == PACKET['STATS'][0]:
+                debug_printf(DEBUG_RCV, "Requesting stats")
+                if end_request(conn, sess, stats_payload()):
+                    break
+            elif data[0] == PACKET['NAK'][0]:
+                debug_printf(DEBUG_RCV, "Requesting retransmit")
+                if sess.udp_address is not None:
+                    retransmit(sess, data)
+                if end_request(conn, sess, None):
+                    break
+            elif data[0] == PACKET['SEEK'][0]:
+                debug_printf(DEBUG_RCV, "Requesting seek")
+                if end_request(conn, sess, seek_stream(sess, data)):
+                    break
+            elif data[0] == PACKET['RCVD'][0]:
+                debug_printf(DEBUG_RCV, "Receive frame ACK")
+                receive_ack(sess, data)
+                if sess.persistent:
+                    # the acknowledgement may have opened the window
+                    stream_frames(conn, sess)
+                    continue
+                close_connection(conn, None)
+                break
+            else:
+                debug_printf(DEBUG_RCV, "BAD COMMAND SENT")
+                if end_request(conn, sess, PACKET['BAD_MESSAGE']):
+                    break
+    except OSError as e:
+        # a reset or broken pipe only ends this connection
+        debug_printf(DEBUG_RCV, "Connection lost: " + str(e))
+    except Exception:
+        # nor does a request that fails, the accept loop carries on
+        print("Error serving " + address + ":")
+        traceback.print_exc()
+    finally:
+        if not handed_off:
+            if sess.persistent:
+                # paced frames would have nowhere to go
+                sess.stop_pacing()
+            conn.close()
+
+# all songs in system, indexed by path
+songs = catalog.Catalog(SONG_DIRECTORY, FILE_EXT)
+
+# frame buffers of the songs streamed lately, see SHARE_BUFFERS
+buffer_cache = session.BufferCache(BUFFER_CACHE_BYTES)
 
 if __name__ == '__main__':
     DEBUG_ALL = 1
     DEBUG_RCV = DEBUG_ALL | 0
     DEBUG_ARGS = DEBUG_ALL | 0
     DEBUG_CMD = DEBUG_ALL | 0
-    start = 0
-    end = 0
     for i in range(1,len(sys.argv)):
         if sys.argv[i] == '--rcvd-off':
             debug_printf(DEBUG_CMD, "Turning NEXT RCVD handshake off")
             RCVD_ACK = 0
+        elif sys.argv[i] == '--no-cache':
+            debug_printf(DEBUG_CMD, "Turning frame cache off")
+            CACHE_FRAMES = 0
+        elif sys.argv[i] == '--no-share':
+            debug_printf(DEBUG_CMD, "Turning shared frame buffers off")
+            SHARE_BUFFERS = 0
+        elif sys.argv[i].startswith('--buffer-cache-bytes='):
+            BUFFER_CACHE_BYTES = int(sys.argv[i].split('=')[1])
+            buffer_cache.budget = BUFFER_CACHE_BYTES
+            debug_printf(DEBUG_CMD, "Frame buffer cache budget: " + str(BUFFER_CACHE_BYTES))
+        elif sys.argv[i].startswith('--session-timeout='):
+            SESSION_TIMEOUT = float(sys.argv[i].split('=')[1])
+            debug_printf(DEBUG_CMD, "Idle session timeout: " + str(SESSION_TIMEOUT))
+        elif sys.argv[i] == '--no-prefetch':
+            debug_printf(DEBUG_CMD, "Turning prefetch off")
+            PREFETCH = 0
+        elif sys.argv[i] == '--progressive':
+            debug_printf(DEBUG_CMD, "Converting songs progressively")
+            PROGRESSIVE = 1
+        elif sys.argv[i] == '--prewarm':
+            debug_printf(DEBUG_CMD, "Prewarming the frame cache")
+            PREWARM = 1
+        elif sys.argv[i].startswith('--prewarm-frame-size='):
+            PREWARM_FRAME_SIZE = int(sys.argv[i].split('=')[1])
+            debug_printf(DEBUG_CMD, "Prewarm frame size: " + str(PREWARM_FRAME_SIZE))
+        elif sys.argv[i] == '--async':
+            debug_printf(DEBUG_CMD, "Serving connections with asyncio")
+            ASYNC_MODE = 1
         elif sys.argv[i] == '--stream-batch':
             debug_printf(DEBUG_CMD, "Streaming in batch")
             STREAM_MODE = STRM_BATCH
@@ -212,11 +1268,28 @@ if __name__ == '__main__':
         else:
             debug_printf(DEBUG_CMD, "Skipping invalid argument: " + sys.argv[i])
 
+    if PREWARM:
+        if CACHE_FRAMES:
+            prewarm(PREWARM_FRAME_SIZE)
+        else:
+            print("Frame cache is off, skipping prewarm")
+
+    if ASYNC_MODE:
+        EXECUTOR = concurrent.futures.ThreadPoolExecutor(WORKERS)
+        asyncio.run(serve_async())
+        sys.exit(0)
+
+    udp_sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sender.bind(('0.0.0.0', UDP_PORT))
+    threading.Thread(target=serve_naks, args=(udp_sender,),
+                     daemon=True).start()
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         # Allow re-binding the same port
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.setsockopt(socket.SOL_SOCKET, socket.TCP_MAXSEG, 8196)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16392)
+        # no SO_SNDBUF: accepted sockets inherit it, and a fixed 16KB
+        # buffer stalls every batch and song stream once it fills up
         # Bind to port on any interface
         sock.bind(('0.0.0.0', PORT))
         sock.listen(100) # allow backlog of 1
@@ -225,132 +1298,5 @@ if __name__ == '__main__':
         # Begin listening for connections
         while(True):
             conn, addr = sock.accept()
-            with conn:
-#                print("\nCONNECTION:", addr)
-                # Receive and handle command
-                while(True):
-                    data = conn.recv(BUFFER_SIZE)
-                    debug_printf(DEBUG_RCV, "Received: " + str(data))
-                    if data[0] == PACKET['SONG_LIST'][0]:
-                        debug_printf(DEBUG_RCV, "Requesting song list")
-                        song_string = ""
-                        for s in songs:
-                            song_string += s
-                            song_string += "\x03"
-                        song_string += '\x04'
-                        close_connection(conn, song_string.encode('ascii'))
-                        break
-                    elif data[0] == PACKET['SHEET'][0]:
-                        debug_printf(DEBUG_RCV, "Requesting sheet music")
-                        close_connection(conn, None)
-                        break
-                    elif data[0] == PACKET['START'][0]:
-                        # receiving a song name, ending with 0x3, with 2bytes following
-                        # forming the size of the frame for this stream
-                        debug_printf(DEBUG_RCV, "Requesting start of stream")
-                        start = time.clock()
-
-                        # split the song from it
-                        song_name_actual = data[1:-3].decode('ascii').split('\x03')[0]
-                        song_name = os.path.join(SONG_DIRECTORY, song_name_actual)
-                        debug_printf(DEBUG_RCV, "Song stripped: " + str(song_name))
-                        if not song_name in songs:
-                            # send back error - song doesnt exist
-                            debug_printf(DEBUG_ARGS, "Song not found. Received: " + song_name)
-                            close_connection(conn, PACKET['ERR'])
-        
-                        current_song = song_name
-                        
-                        # get number of bytes for frames
-                        # assume big endian
-                        bytes_len = int.from_bytes(data[1 + len(song_name_actual) + 1:], byteorder='big')
-                        current_frame_size = bytes_len
-                        #initializes the song
-                        # opens file, converts to FFT, stores frames, and 
-                        # puts cursor in start position
-                        debug_printf(DEBUG_ARGS, "Frame size: " + str(current_frame_size))
-                        debug_printf(DEBUG_ARGS, "Requested song: " + current_song)
-                        initialize_song()
-                        close_connection(conn, PACKET['START_ACK'])
-                        break
-        
-                    elif data[0] == PACKET['NEXT'][0]:
-        
-                        # streams it in batch mode - expects a number of requests to follow
-                        num_to_follow = 0
-                        if STREAM_MODE == STRM_BATCH:
-                            num_to_follow = int.from_bytes(data[-2:], byteorder='big')
-                            if num_to_follow > len(song_buffer) - current_frame:
-                                num_to_follow = len(song_buffer) - current_frame # limit near end of song
-                        elif STREAM_MODE == STRM_SEPARATE:
-                            num_to_follow = 1
-                        elif STREAM_MODE == STRM_SONG:
-                            num_to_follow = len(song_buffer) - current_frame # rest of song
-        
-                        debug_printf(DEBUG_RCV, "Requesting next frame")
-                        ending = b""
-                        if current_frame == -1:
-                            # stream is not open
-                            debug_printf(DEBUG_RCV, "Asked for frame with no stream open")
-                            close_connection(conn, PACKET['ERR'])
-                        elif current_frame == len(song_buffer):
-                            # cannot request
-                            debug_printf(DEBUG_RCV, "Asked for frame beyond stream end")
-                            reinit_current_song()
-                            close_connection(conn, PACKET['ERR'])
-                            break
-        
-                        # stream loop now
-                        frame_to_send = 0
-                        while frame_to_send < num_to_follow:
-                            debug_printf(DEBUG_RCV, "Length of song_buffer: " + str(len(song_buffer)))
-                            # start it with frame position
-                            beginning = b"\xFF\xFF\xFF\xFF"
-                            ending = b"\x04"
-                            if current_frame < len(song_buffer) - 1:
-                                # should end with 0x03
-                                ending = b"\x03"
-                                beginning = struct.pack('i', current_frame)
-                                debug_printf(DEBUG_RCV, "Frame bytes: " + str(beginning))
-                            else:
-                                end = time.clock()
-                                print("Time to download song: " + str(end - start))
-                            ba = beginning + song_buffer[current_frame]
-        
-    #                        ba += ending
-                            conn.send(ba)
-                             
-                            if None:
-                                while data[0] != PACKET['RCVD'][0] and data[0] != PACKET['STOP'][0]:
-                                    data = conn.recv(BUFFER_SIZE)
-                                
-                                # might need fix - since connection will be closed twice
-                                if data[0] == PACKET['STOP'][0]:
-                                        #reinit_current_song()
-                                    close_connection(conn, PACKET['STOP_ACK'])
-                                debug_printf(DEBUG_RCV, "Got a RCVD")
-        
-                            current_frame += 1
-                            frame_to_send += 1
-
-                        # reached the end time to leave
-                        #reinit_current_song()
-                        close_connection(conn, None)
-                        break
-                        
-                    elif data[0] == PACKET['STOP'][0]:
-                        debug_printf(DEBUG_RCV, "Requesting stop frame")
-                        reinit_current_song()
-                        close_connection(conn, PACKET['STOP_ACK'])
-                        break
-                    elif data[0] == PACKET['RCVD'][0]:
-                        debug_printf(DEBUG_RCV, "Receive frame ACK")
-                        current_frame += 1 # increase frame counter 
-                        close_connection(conn, None)
-                        break
-                    else:
-                        debug_printf(DEBUG_RCV, "BAD COMMAND SENT")
-                        close_connection(conn, PACKET['BAD_MESSAGE'])
-                        break
-
-
+            stats.mark('connections')
+            serve_connection(conn, addr[0])
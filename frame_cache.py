@@ -0,0 +1,115 @@
+# This file keeps packed song frames on disk so a song only has to be
+# converted once for a given set of stream parameters. Each cache file is the
+# record buffer of a frames.FrameBuffer written out verbatim, and is served
+# back through an mmap, so cached songs live in the page cache rather than on
+# the server's heap.
+import hashlib
+import mmap
+import os
+import tempfile
+
+import frames
+import stats
+
+CACHE_DIRECTORY = "frame_cache"
+CACHE_EXT = ".frames"
+
+# Bump whenever the layout of the cached records changes.
+CACHE_VERSION = 2
+
+def cache_key(song, fft_size, ffts_actual_bits, fft_bits, frame_size,
+              byte_order=frames.NATIVE, fft_options=None):
+    """ Builds the cache key for a song and the parameters it is packed with.
+
+    The song's modification time and size are part of the key, so editing or
+    replacing a wav file never serves stale frames.
+    """
+    path = os.path.abspath(song)
+    st = os.stat(path)
+    return (CACHE_VERSION, path, st.st_mtime_ns, st.st_size, fft_size,
+            ffts_actual_bits, fft_bits, frame_size, byte_order,
+            tuple(sorted((fft_options or {}).items())))
+
+def cache_path(key, directory=CACHE_DIRECTORY):
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(directory, digest + CACHE_EXT)
+
+def load(key, frame_size, directory=CACHE_DIRECTORY):
+    """ Returns a memory-mapped FrameBuffer for key, or None on a miss.
+
+    Args:
+        key: A key returned by cache_key.
+        frame_size: Number of point bytes in each cached frame (see
+                    frames.frame_bytes).
+        directory: The cache directory.
+    """
+    path = cache_path(key, directory)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        stats.incr('cache_misses')
+        return None
+    stats.incr('cache_hits')
+    return _map(f, frame_size)
+
+def _map(f, frame_size):
+    # maps the open cache file f, which the FrameBuffer then owns
+    if os.fstat(f.fileno()).st_size == 0:
+        f.close()
+        return frames.FrameBuffer(b"", frame_size)
+    song_buffer = frames.FrameBuffer(
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), frame_size)
+    # keep the file open for sendfile
+    song_buffer.file = f
+    return song_buffer
+
+def store(key, song_buffer, directory=CACHE_DIRECTORY):
+    """ Writes the records of song_buffer to the cache file for key.
+
+    The file is written under a temporary name and renamed into place, so
+    concurrent readers never see a partially written song.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with stats.timed('cache_store'):
+        _store(key, song_buffer, directory)
+
+def _store(key, song_buffer, directory):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(song_buffer.buffer)
+        os.replace(tmp_path, cache_path(key, directory))
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def build(key, frame_size, blocks, directory=CACHE_DIRECTORY):
+    """ Writes a song to the cache file for key as it is converted.
+
+    Unlike store, the song never has to be held in memory as a whole: each
+    block of records is appended to the file as soon as it is packed. The
+    file is renamed into place once complete, as in store.
+
+    Args:
+        key: A key returned by cache_key.
+        frame_size: Number of point bytes in each frame (see
+                    frames.frame_bytes).
+        blocks: An iterable of consecutive blocks of wire-ready records, in
+                    song order.
+
+    Returns:
+        A memory-mapped FrameBuffer of the new cache file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = cache_path(key, directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for records in blocks:
+                f.write(records)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    # mapped directly, the lookup that missed already counted this START
+    return _map(open(path, 'rb'), frame_size)
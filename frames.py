@@ -0,0 +1,264 @@
+# This file packs quantized FFT magnitudes into the fixed size frames that the
+# server streams to the boards. All frames of a song live back to back in one
+# contiguous buffer as wire-ready records (frame index header followed by the
+# points), and individual frames are handed out as memoryview slices into it,
+# so a song costs roughly its raw payload size in memory.
+import numpy
+import sys
+import threading
+
+import stats
+
+# Every frame on the wire starts with its index as a 32 bit int, or
+# LAST_FRAME for the final frame of a song.
+HEADER_SIZE = 4
+LAST_FRAME = b"\xFF\xFF\xFF\xFF"
+
+# Byte orders a frame can be packed in, as numpy/struct prefixes. Both the
+# header and the points use the stream's byte order; NATIVE is what the
+# server has always sent to boards that don't ask for one.
+NATIVE = '='
+LITTLE_ENDIAN = '<'
+BIG_ENDIAN = '>'
+
+# fft_bits value of the packed format: two 12 bit points in three bytes
+PACKED_12 = 12
+
+def point_format(fft_bits):
+    """ Returns the (struct format, bytes per point) used to send one FFT
+    point of fft_bits bits. All points are treated as unsigned and padded up
+    to the next standard width, except PACKED_12 points (see point_bits).
+    """
+    if fft_bits <= 8:
+        return 'B', 1
+    elif fft_bits <= 16:
+        return 'H', 2
+    elif fft_bits <= 32:
+        return 'I', 4
+    else:
+        return 'Q', 8
+
+class FrameBuffer(object):
+    """ A read-only sequence of equally sized frames stored in one buffer.
+
+    Frames are stored as wire-ready records: a HEADER_SIZE byte frame index
+    (LAST_FRAME for the final frame) followed by frame_size bytes of points.
+    Indexing returns a memoryview of a frame's points, and record/records
+    return the header and points of one or more consecutive frames, so no
+    frame is ever copied until it is written to a socket.
+    """
+    def __init__(self, buffer, frame_size):
+        self.buffer = memoryview(buffer).cast('B')
+        self.frame_size = frame_size
+        self.record_size = HEADER_SIZE + frame_size
+        self.num_frames = len(self.buffer) // self.record_size
+        # file holding the same records at the same offsets, when the buffer
+        # is a mapping of it, so they can be sent with sendfile
+        self.file = None
+        # number of frames that can be sent right away
+        self.ready = self.num_frames
+
+    def wait_for(self, index):
+        """ Blocks until frame index can be sent, returns ready. """
+        return self.num_frames
+
+    def __len__(self):
+        return self.num_frames
+
+    def _check_index(self, index):
+        if index < 0:
+            index += self.num_frames
+        if index < 0 or index >= self.num_frames:
+            raise IndexError("frame index out of range")
+        return index
+
+    def __getitem__(self, index):
+        start = self.offset(self._check_index(index)) + HEADER_SIZE
+        return self.buffer[start:start + self.frame_size]
+
+    def record(self, index):
+        """ Header and points of frame index, as sent on the wire. """
+        start = self.offset(self._check_index(index))
+        return self.buffer[start:start + self.record_size]
+
+    def records(self, start, stop):
+        """ Wire-ready records of frames [start, stop) as one memoryview. """
+        stop = min(stop, self.num_frames)
+        return self.buffer[self.offset(start):self.offset(stop)]
+
+    def offset(self, index):
+        """ Byte offset of the record of frame index inside the buffer. """
+        return index * self.record_size
+
+    @property
+    def nbytes(self):
+        return len(self.buffer)
+
+def point_bits(fft_bits):
+    """ Number of bits a point of fft_bits bits takes on the wire. PACKED_12
+    points are packed two to three bytes, every other width is padded as in
+    point_format.
+    """
+    if fft_bits == PACKED_12:
+        return PACKED_12
+    struct_pack, bytes_per_point = point_format(fft_bits)
+    return bytes_per_point * 8
+
+def frame_bytes(fft_bits, frame_size):
+    """ Number of point bytes actually carried by a frame of frame_size
+    bytes, which is frame_size rounded down to a whole number of points
+    (of point pairs for PACKED_12).
+    """
+    if fft_bits == PACKED_12:
+        return (frame_size // 3) * 3
+    struct_pack, bytes_per_point = point_format(fft_bits)
+    return (frame_size // bytes_per_point) * bytes_per_point
+
+def frames_per_fft(fft_bits, frame_size, num_points):
+    """ Number of frames of frame_size bytes that an FFT of num_points points
+    is split into. The last frame of an FFT is padded with zero points when
+    they don't fill it, so no point is dropped. 0 if a frame can't hold a
+    single point.
+    """
+    points_per_frame = frame_bytes(fft_bits, frame_size) * 8 // point_bits(
+        fft_bits)
+    if not points_per_frame:
+        return 0
+    return -(-num_points // points_per_frame)
+
+def pack_records(records, ffts, fft_bits, first_frame, num_frames,
+                 byte_order=NATIVE):
+    """ Packs a block of FFTs into wire-ready records.
+
+    Args:
+        records: A writable (n, HEADER_SIZE + payload size) uint8 array that
+                    receives one frame per row.
+        ffts: The (n_ffts, fft_size) FFT magnitudes to pack; n must be a
+                    multiple of n_ffts.
+        fft_bits: Number of bits each point is sent with on the wire.
+        first_frame: Index of the first frame in records.
+        num_frames: Number of frames in the whole song, so the last one gets
+                    the LAST_FRAME header.
+        byte_order: NATIVE, LITTLE_ENDIAN or BIG_ENDIAN, for both the header
+                    and the points.
+    """
+    with stats.timed('pack'):
+        _pack_records(records, ffts, fft_bits, first_frame, num_frames,
+                      byte_order)
+
+def _pack_records(records, ffts, fft_bits, first_frame, num_frames,
+                  byte_order):
+    count = len(records)
+    points_per_frame = (records.shape[1] - HEADER_SIZE) * 8 // point_bits(
+        fft_bits)
+    points_used = (count // max(len(ffts), 1)) * points_per_frame
+
+    headers = numpy.arange(first_frame, first_frame + count,
+                           dtype=numpy.dtype(byte_order + 'i4'))
+    if count and first_frame + count == num_frames:
+        headers[-1] = -1 # LAST_FRAME
+    records[:, :HEADER_SIZE] = headers.view(numpy.uint8).reshape(-1,
+                                                                 HEADER_SIZE)
+    if points_used > ffts.shape[1]:
+        # the last frame of each FFT is padded with zero points
+        padded = numpy.zeros((len(ffts), points_used), dtype=ffts.dtype)
+        padded[:, :ffts.shape[1]] = ffts
+        ffts = padded
+    points = ffts[:, :points_used].reshape(count, points_per_frame)
+    if fft_bits == PACKED_12:
+        pack_12(records[:, HEADER_SIZE:], points, byte_order)
+        return
+    struct_pack, bytes_per_point = point_format(fft_bits)
+    numpy.copyto(records[:, HEADER_SIZE:].view(
+                     numpy.dtype(byte_order + struct_pack)),
+                 points, casting='unsafe')
+
+def pack_12(payload, points, byte_order):
+    """ Packs each pair of points (a, b) into three bytes of payload. In
+    little endian order the bytes are a[7:0], b[3:0] a[11:8], b[11:4]; in big
+    endian order a[11:4], a[3:0] b[11:8], b[7:0].
+    """
+    if byte_order == NATIVE:
+        byte_order = LITTLE_ENDIAN if sys.byteorder == 'little' else BIG_ENDIAN
+    points = points.astype(numpy.uint16) & 0xFFF
+    a = points[:, 0::2]
+    b = points[:, 1::2]
+    triples = payload.reshape(len(payload), -1, 3)
+    if byte_order == LITTLE_ENDIAN:
+        triples[:, :, 0] = a
+        triples[:, :, 1] = (a >> 8) | (b << 4)
+        triples[:, :, 2] = b >> 4
+    else:
+        triples[:, :, 0] = a >> 4
+        triples[:, :, 1] = (a << 4) | (b >> 8)
+        triples[:, :, 2] = b
+
+def pack_frames(ffts, fft_bits, frame_size, byte_order=NATIVE):
+    """ Packs a matrix of quantized FFTs into frames of frame_size bytes.
+
+    Each FFT is split into frames_per_fft frames, the last of which is
+    padded with zero points if the FFT doesn't fill it. The whole matrix
+    is cast to the point width in a single numpy operation, straight into the
+    record buffer.
+
+    Args:
+        ffts: A (n_ffts, fft_size) array of FFT magnitudes.
+        fft_bits: Number of bits each point is sent with on the wire.
+        frame_size: Requested number of bytes in each frame.
+        byte_order: NATIVE, LITTLE_ENDIAN or BIG_ENDIAN.
+
+    Returns:
+        A FrameBuffer holding every frame of the song in order.
+    """
+    payload_size = frame_bytes(fft_bits, frame_size)
+    if payload_size == 0:
+        raise ValueError("frame size {} is smaller than a point".format(
+            frame_size))
+
+    num_frames = len(ffts) * frames_per_fft(fft_bits, frame_size,
+                                            ffts.shape[1])
+    records = numpy.empty((num_frames, HEADER_SIZE + payload_size),
+                          dtype=numpy.uint8)
+    pack_records(records, ffts, fft_bits, 0, num_frames, byte_order)
+    return FrameBuffer(records.reshape(-1), payload_size)
+
+class ProgressiveFrameBuffer(FrameBuffer):
+    """ A FrameBuffer that is filled in order by a producer thread while it
+    is being streamed.
+
+    The size of the song is known up front, so the records are allocated
+    once. Frames below ready can be sent; wait_for blocks a consumer that
+    gets ahead of the producer.
+    """
+    def __init__(self, num_frames, frame_size):
+        FrameBuffer.__init__(self,
+                             bytearray(num_frames * (HEADER_SIZE + frame_size)),
+                             frame_size)
+        self.ready = 0
+        self.error = None
+        self.condition = threading.Condition()
+
+    def records_array(self, start, stop):
+        """ Writable uint8 array of the records of frames [start, stop). """
+        records = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+        return records.reshape(-1, self.record_size)[start:stop]
+
+    def extend(self, count):
+        """ Marks count more frames as produced. """
+        with self.condition:
+            self.ready += count
+            self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    def wait_for(self, index):
+        with self.condition:
+            while (self.ready <= index and self.ready < self.num_frames and
+                   self.error is None):
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            return self.ready
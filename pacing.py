@@ -0,0 +1,182 @@
+# This file sends paced streams in step with the audio they were taken from.
+# Frame i of a song is due when its FFT window starts in the song, i.e. at
+# the start of the stream plus window * hop / sample_rate seconds, and a
+# single scheduler thread sends the frames of every paced session when they
+# are due, in deadline order, so boards hold a few frames at a time and stay
+# in sync with playback however many of them there are.
+import heapq
+import itertools
+import threading
+import time
+
+import stats
+
+# A frame that goes out more than this many seconds after its deadline
+# counts as a deadline miss.
+MISS_TOLERANCE = 0.005
+
+# Seconds between two tries at a stream with frames due that can't be sent
+# yet: the board's flow control window or its socket is full, another thread
+# holds the session, or the song is still being converted.
+BLOCKED_POLL = 0.002
+
+class PacedStream(object):
+    """ When each frame of a session is due, and how late they went out.
+
+    Deadlines are counted from an anchor: the frame the stream started or
+    seeked to, due at the time it did. Every frames_per_tick frames (the
+    frames of one FFT window) are due period seconds after the previous
+    ones.
+
+    Ticks run under the session's lock, which they only try to take: a
+    session busy on its connection's thread is tried again shortly instead
+    of holding up the other streams.
+    """
+    def __init__(self, sess, period, frames_per_tick, send, writable=None):
+        self.sess = sess
+        self.period = period
+        self.frames_per_tick = max(frames_per_tick, 1)
+        # send(stream, first, stop) sends frames [first, stop) of sess
+        # without blocking, and writable() tells whether it can take more
+        self.send = send
+        self.writable = writable
+        self.cancelled = False
+        self.scheduled = False
+        self.anchor(sess.current_frame)
+        # how late frames went out, and the interarrival jitter of that
+        # lateness smoothed as in RFC 3550
+        self.lateness = stats.Histogram()
+        self.jitter = 0.0
+        self.last_lateness = None
+        self.misses = 0
+
+    def anchor(self, index, now=None):
+        """ Makes frame index due now, the frames after it counting from
+        there (start of the stream or a seek).
+        """
+        self.first = index
+        self.epoch = time.monotonic() if now is None else now
+
+    def deadline(self, index):
+        return self.epoch + ((index - self.first) // self.frames_per_tick
+                             * self.period)
+
+    def due(self, now):
+        """ Index of the first frame not due yet at now. """
+        ticks = int((now - self.epoch) // self.period) + 1 if self.period else 0
+        return self.first + ticks * self.frames_per_tick
+
+    def cancel(self):
+        self.cancelled = True
+
+    def tick(self, now):
+        """ Sends the frames due at now that the board asked for and has room
+        for. Returns when the stream next needs the scheduler, or None if it
+        has nothing left to send until the board asks for more.
+        """
+        sess = self.sess
+        if not sess.lock.acquire(blocking=False):
+            return now + BLOCKED_POLL
+        try:
+            return self._tick(now)
+        finally:
+            sess.lock.release()
+
+    def _tick(self, now):
+        sess = self.sess
+        index = sess.current_frame
+        if self.cancelled or index == -1 or index < self.first:
+            return None
+        deadline = self.deadline(index)
+        if deadline > now:
+            return deadline
+        limit = min(sess.send_limit(), sess.song_buffer.ready)
+        if limit <= index:
+            if sess.target > index:
+                return now + BLOCKED_POLL
+            return None
+        if self.writable is not None and not self.writable():
+            return now + BLOCKED_POLL
+        stop = min(limit, self.due(now), len(sess.song_buffer))
+        self.observe(now - deadline)
+        sess.current_frame = stop
+        self.send(self, index, stop)
+        if stop >= len(sess.song_buffer):
+            return None
+        return max(self.deadline(stop), now)
+
+    def observe(self, lateness):
+        self.lateness.add(int(lateness * 1e9))
+        stats.observe('pace_lateness', int(lateness * 1e9))
+        if self.last_lateness is not None:
+            self.jitter += (abs(lateness - self.last_lateness) -
+                            self.jitter) / 16
+        self.last_lateness = lateness
+        if lateness > MISS_TOLERANCE:
+            self.misses += 1
+            stats.incr('deadline_misses')
+
+    def snapshot(self):
+        return {'period_s': self.period,
+                'frames_per_tick': self.frames_per_tick,
+                'jitter_ns': int(self.jitter * 1e9),
+                'deadline_misses': self.misses,
+                'lateness': self.lateness.snapshot()}
+
+class Scheduler(object):
+    """ Runs the ticks of every PacedStream from one thread, earliest
+    deadline first.
+
+    Streams are kept in a heap by the time they next need to run; the
+    thread sleeps until the earliest of them on a monotonic clock, or until
+    wake() adds a stream that needs to run sooner.
+    """
+    def __init__(self):
+        self.heap = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def wake(self, stream):
+        """ Schedules stream to run now, unless it already is scheduled. """
+        with self.condition:
+            if stream.scheduled:
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self._push(time.monotonic(), stream)
+            self.condition.notify()
+
+    def _push(self, when, stream):
+        stream.scheduled = True
+        heapq.heappush(self.heap, (when, next(self.order), stream))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.condition.wait(self.heap[0][0] - now
+                                        if self.heap else None)
+                when, order, stream = heapq.heappop(self.heap)
+                stream.scheduled = False
+            try:
+                when = stream.tick(now)
+            except OSError:
+                # the board is gone
+                stream.cancel()
+                when = None
+            except Exception as e:
+                print("Paced stream failed: " + str(e))
+                stream.cancel()
+                when = None
+            if when is not None:
+                with self.condition:
+                    if not stream.scheduled:
+                        self._push(when, stream)
@@ -1,3 +1,4 @@
+
 def all_packets():
     PACKET = {}
     PACKET['SONG_LIST'] =   "\x01".encode('ascii')
@@ -10,4 +11,189 @@ def all_packets():
     PACKET['RCVD'] =        "\x08".encode('ascii')
     PACKET['ERR'] =         "\x09".encode('ascii')
     PACKET['BAD_MESSAGE'] = "\x0a".encode('ascii')
+    PACKET['STATS'] =       "\x0b".encode('ascii')
+    PACKET['SEEK'] =        "\x0c".encode('ascii')
+    PACKET['SEEK_ACK'] =    "\x0d".encode('ascii')
+    PACKET['NAK'] =         "\x0e".encode('ascii')
+    PACKET['SHEET_RANGE'] = "\x0f".encode('ascii')
     return PACKET
+
+# START is the opcode, the song name ending with 0x3, and the frame size in
+# two big endian bytes. Options for the stream can follow the song name as
+# "\x1fkey=value" pairs, so the message keeps the same framing.
+FIELD_END = "\x03"
+OPTION_SEP = "\x1f"
+
+def encode_start(song, frame_size, options=None):
+    """ Builds a START message for song with frames of frame_size bytes and
+    the given dict of stream options.
+    """
+    fields = song
+    for key, value in (options or {}).items():
+        fields += OPTION_SEP + "{}={}".format(key, value)
+    return (all_packets()['START'] + (fields + FIELD_END).encode('ascii') +
+            frame_size.to_bytes(2, byteorder='big'))
+
+def parse_start(data):
+    """ Splits a START message into (song name, frame size, options). """
+    try:
+        fields = data[1:-3].decode('ascii').split(FIELD_END)[0]
+    except UnicodeDecodeError:
+        raise ProtocolError("START song name is not ascii")
+    # get number of bytes for frames
+    # assume big endian
+    frame_size = int.from_bytes(data[1 + len(fields) + 1:], byteorder='big')
+    parts = fields.split(OPTION_SEP)
+    options = {}
+    for part in parts[1:]:
+        key, _, value = part.partition('=')
+        options[key] = value
+    return parts[0], frame_size, options
+
+# With windowed flow control RCVD carries the index of the highest frame
+# received as four big endian bytes, 0xFFFFFFFF for the last frame.
+RCVD_INDEX_SIZE = 5
+
+def encode_rcvd(index):
+    return all_packets()['RCVD'] + (index & 0xFFFFFFFF).to_bytes(4, 'big')
+
+def parse_rcvd(data):
+    """ Returns the frame index carried by a windowed RCVD, -1 for the last
+    frame of the song.
+    """
+    index = int.from_bytes(data[1:RCVD_INDEX_SIZE], byteorder='big')
+    if index == 0xFFFFFFFF:
+        return -1
+    return index
+
+# SEEK is the opcode, a unit byte and a four byte big endian position: a
+# frame index for SEEK_FRAME, milliseconds from the start of the song for
+# SEEK_TIME. SEEK_ACK carries the index of the frame the stream moved to in
+# the same four bytes.
+SEEK_SIZE = 6
+SEEK_FRAME = 0
+SEEK_TIME = 1
+
+def encode_seek(position, unit=SEEK_FRAME):
+    return (all_packets()['SEEK'] + bytes([unit]) +
+            position.to_bytes(4, byteorder='big'))
+
+def parse_seek(data):
+    """ Splits a SEEK message into (unit, position). """
+    if data[1] not in (SEEK_FRAME, SEEK_TIME):
+        raise ProtocolError("SEEK with unknown unit {}".format(data[1]))
+    return data[1], int.from_bytes(data[2:SEEK_SIZE], byteorder='big')
+
+def encode_seek_ack(index):
+    return all_packets()['SEEK_ACK'] + index.to_bytes(4, byteorder='big')
+
+# NAK is the opcode, the index of the first frame missing in four big endian
+# bytes and the number of frames missing from it in two.
+NAK_SIZE = 7
+
+def encode_nak(first, count=1):
+    return (all_packets()['NAK'] + first.to_bytes(4, byteorder='big') +
+            count.to_bytes(2, byteorder='big'))
+
+def parse_nak(data):
+    """ Splits a NAK message into (first frame missing, frames missing). """
+    return (int.from_bytes(data[1:5], byteorder='big'),
+            int.from_bytes(data[5:NAK_SIZE], byteorder='big'))
+
+# SHEET_RANGE is the opcode and the frames [first, stop) to send the notes
+# of, each in four big endian bytes. It has an opcode of its own so the one
+# byte SHEET of older boards is still read as a single byte.
+SHEET_RANGE_SIZE = 9
+
+def encode_sheet(first, stop):
+    return (all_packets()['SHEET_RANGE'] + first.to_bytes(4, byteorder='big') +
+            stop.to_bytes(4, byteorder='big'))
+
+def parse_sheet(data):
+    """ Splits a SHEET_RANGE message into (first frame, stop frame). """
+    return (int.from_bytes(data[1:5], byteorder='big'),
+            int.from_bytes(data[5:SHEET_RANGE_SIZE], byteorder='big'))
+
+class ProtocolError(ValueError):
+    """ Raised for bytes that can't be parsed as a request. """
+
+# Longest START accepted, so a missing 0x3 can't grow the buffer forever.
+MAX_START_SIZE = 1024
+
+class MessageDecoder(object):
+    """ Incrementally splits the bytes received on a connection into
+    complete requests.
+
+    Reads can end in the middle of a request or hold several back to back
+    requests, so data is fed in as it arrives and complete requests are taken
+    out one at a time with next_message. Requests are returned in order,
+    which lets a client pipeline several NEXTs without waiting for each
+    frame.
+    """
+    def __init__(self, next_size=1):
+        PACKET = all_packets()
+        self.buffer = bytearray()
+        self.offset = 0
+        # Length of a NEXT request, 3 when the count of frames to stream
+        # follows it (STRM_BATCH).
+        self.next_size = next_size
+        # Length of a RCVD request, RCVD_INDEX_SIZE when the board sends the
+        # index of the highest frame received (windowed flow control).
+        self.rcvd_size = 1
+        self.start = PACKET['START'][0]
+        self.next = PACKET['NEXT'][0]
+        self.rcvd = PACKET['RCVD'][0]
+        self.seek = PACKET['SEEK'][0]
+        self.nak = PACKET['NAK'][0]
+        self.sheet_range = PACKET['SHEET_RANGE'][0]
+
+    def feed(self, data):
+        # drop the requests already handed out before growing the buffer
+        if self.offset:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def message_size(self):
+        """ Size of the request at the head of the buffer, or None if it has
+        not been completely received yet.
+        """
+        available = len(self.buffer) - self.offset
+        if available == 0:
+            return None
+        opcode = self.buffer[self.offset]
+        if opcode == self.start:
+            # the song name ends with 0x3, then two bytes of frame size
+            end = self.buffer.find(FIELD_END.encode('ascii'), self.offset + 1)
+            if end == -1:
+                if available > MAX_START_SIZE:
+                    raise ProtocolError("START without a song name end")
+                return None
+            size = end - self.offset + 3
+        elif opcode == self.next:
+            size = self.next_size
+        elif opcode == self.rcvd:
+            size = self.rcvd_size
+        elif opcode == self.seek:
+            size = SEEK_SIZE
+        elif opcode == self.nak:
+            size = NAK_SIZE
+        elif opcode == self.sheet_range:
+            size = SHEET_RANGE_SIZE
+        else:
+            size = 1
+        if size > available:
+            return None
+        return size
+
+    def next_message(self):
+        """ Returns the next complete request as bytes, or None if more data
+        is needed.
+        """
+        size = self.message_size()
+        if size is None:
+            return None
+        message = bytes(self.buffer[self.offset:self.offset + size])
+        self.offset += size
+        return message
+
@@ -0,0 +1,150 @@
+# This file guesses which song a board will play next and converts it into
+# the frame cache while the current one streams, so the next START finds its
+# frames ready instead of stalling on the conversion. Guesses come from a
+# playlist sent by the board, from the order songs were played in before,
+# or from the order of the catalog. Prefetches run on low priority worker
+# threads, a bounded number at a time, so they never hold up active streams.
+import collections
+import concurrent.futures
+import os
+import threading
+
+import frame_cache
+import frames
+import session
+import stats
+
+# Number of songs converted at the same time by prefetches. A prefetch that
+# would exceed it is skipped rather than queued.
+PREFETCH_WORKERS = 1
+
+# Niceness added to the prefetch worker threads (Linux schedules threads on
+# their own), so conversions only use CPU time active streams leave.
+PREFETCH_NICE = 10
+
+class PlayOrder(object):
+    """ The order in which boards play songs.
+
+    Every START is recorded against the song the same board started before
+    it, which gives, for each song, how often every other song followed it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # last song started by each board
+        self.last = {}
+        # playlist sent by each board, as song paths
+        self.playlists = {}
+        # song -> Counter of the songs started right after it
+        self.transitions = collections.defaultdict(collections.Counter)
+
+    def record(self, board, song, playlist=None):
+        """ Records that board started song, with the playlist it sent in
+        START, if any.
+        """
+        with self.lock:
+            previous = self.last.get(board)
+            if previous is not None and previous != song:
+                self.transitions[previous][song] += 1
+            self.last[board] = song
+            if playlist:
+                self.playlists[board] = list(playlist)
+
+    def predict(self, board, song, catalog_order=()):
+        """ Returns the song board is most likely to start after song, or
+        None if there is no other song to guess.
+
+        Args:
+            board: The board playing song.
+            song: The song being played.
+            catalog_order: Every song, in catalog order, for a board with no
+                    playlist and a song never seen followed by another.
+        """
+        with self.lock:
+            playlist = self.playlists.get(board)
+            if playlist:
+                if song not in playlist:
+                    return playlist[0]
+                index = playlist.index(song)
+                if index + 1 < len(playlist):
+                    return playlist[index + 1]
+            followers = self.transitions.get(song)
+            if followers:
+                return followers.most_common(1)[0][0]
+        songs = list(catalog_order)
+        if song in songs and len(songs) > 1:
+            return songs[(songs.index(song) + 1) % len(songs)]
+        return None
+
+def lower_priority():
+    if hasattr(os, 'setpriority') and hasattr(threading, 'get_native_id'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(),
+                           PREFETCH_NICE)
+        except OSError:
+            pass
+
+class Prefetcher(object):
+    """ Converts songs into the frame cache in the background. """
+    def __init__(self, workers=PREFETCH_WORKERS):
+        self.workers = workers
+        self.executor = None
+        # cache key -> future of every prefetch in flight
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def submit(self, song, frame_size, fft_size, ffts_actual_bits, fft_bits,
+               byte_order=frames.NATIVE, fft_options=None):
+        """ Starts converting song with the given stream parameters (see
+        session.load_song), unless it is cached or being converted already,
+        or all workers are busy. Returns True if a prefetch was started.
+        """
+        try:
+            key = frame_cache.cache_key(song, fft_size, ffts_actual_bits,
+                                        fft_bits, frame_size, byte_order,
+                                        fft_options)
+        except OSError:
+            return False
+        if os.path.exists(frame_cache.cache_path(key)):
+            return False
+        with self.lock:
+            if key in self.pending:
+                return False
+            if len(self.pending) >= self.workers:
+                stats.incr('prefetch_skipped')
+                return False
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    self.workers, initializer=lower_priority)
+            future = self.executor.submit(
+                session.load_song, song, frame_size, fft_size,
+                ffts_actual_bits, fft_bits, True, byte_order, fft_options)
+            self.pending[key] = future
+        stats.incr('prefetch_started')
+        future.add_done_callback(lambda future: self._done(key, future))
+        return True
+
+    def _done(self, key, future):
+        with self.lock:
+            self.pending.pop(key, None)
+        if future.exception() is not None:
+            stats.incr('prefetch_failed')
+            print("Prefetch failed: " + str(future.exception()))
+        else:
+            stats.incr('prefetch_done')
+
+    def wait(self, song, frame_size, fft_size, ffts_actual_bits, fft_bits,
+             byte_order=frames.NATIVE, fft_options=None):
+        """ Waits for the prefetch of song with these parameters, if one is
+        in flight, so a START for it doesn't convert it a second time.
+        """
+        try:
+            key = frame_cache.cache_key(song, fft_size, ffts_actual_bits,
+                                        fft_bits, frame_size, byte_order,
+                                        fft_options)
+        except OSError:
+            return
+        with self.lock:
+            future = self.pending.get(key)
+        if future is not None:
+            stats.incr('prefetch_waits')
+            concurrent.futures.wait([future])
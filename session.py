@@ -0,0 +1,428 @@
+# This file holds the playback state of a single board. The server keeps one
+# Session per client so several boards can stream different songs at the same
+# time, and the song loading below is safe to run on a worker thread.
+import collections
+import numpy
+import threading
+import time
+import weakref
+
+import frames
+import frame_cache
+import stats
+import wav_to_fft
+
+# Number of FFTs converted at a time when a song is loaded progressively.
+# Small, so the first frames are ready almost as soon as START is handled.
+PROGRESSIVE_BLOCK_WINDOWS = 64
+
+# Number of FFTs converted at a time by load_song. This, not the length of
+# the song, bounds the memory a conversion takes.
+LOAD_BLOCK_WINDOWS = 512
+
+# Bytes of frame buffers a BufferCache keeps in memory by default once no
+# session streams them.
+BUFFER_CACHE_BYTES = 256 * 1024 * 1024
+
+# every session still referenced, for the STATS report
+live_sessions = weakref.WeakSet()
+
+class Session(object):
+    """ Playback state of one board: the song being streamed, its packed
+    frames and the cursor of the next frame to send.
+    """
+    def __init__(self, address=None):
+        self.address = address
+        # persistent sessions own their connection for the whole song
+        self.persistent = False
+        # maximum number of unacknowledged frames in flight, 0 for no limit
+        self.window = 0
+        # length of the RCVD requests sent by the board
+        self.rcvd_size = 1
+        # stream mode asked for in START, 0 for the server's default
+        self.stream_mode = 0
+        # totals over the life of the session
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.pacer = None
+        # held while the cursor moves or frames are written, by the
+        # connection's thread and by the pacing scheduler's
+        self.lock = threading.RLock()
+        # non-blocking writer of a paced persistent connection, see
+        # echoserver.ConnectionWriter
+        self.writer = None
+        # hold on the song_buffer of a BufferCache, if it came from one
+        self.buffer_lease = None
+        # time.monotonic() of the last request or frame sent
+        self.last_active = time.monotonic()
+        self.reset()
+        live_sessions.add(self)
+
+    def reset(self):
+        """ Forgets the current song (STOP or end of stream). """
+        with self.lock:
+            self.song = None
+            self.frame_size = 0
+            # point width, quantization and byte order negotiated in START
+            self.fft_bits = 0
+            self.ffts_actual_bits = 0
+            self.byte_order = frames.NATIVE
+            # extra arguments of the FFT stage, see load_song
+            self.fft_options = {}
+            self.release_buffer()
+            self.song_buffer = []
+            # number of frames of a song that was streamed to the end
+            self.song_frames = 0
+            # what a time offset in SEEK is converted to a frame index with
+            self.sample_rate = 0
+            self.frames_per_fft = 0
+            # FFTs taken of each window, one per channel streamed
+            self.ffts_per_window = 1
+            # (host, port) the frames are sent to as datagrams, None over TCP,
+            # at most rate frames per second (0 for no limit)
+            self.udp_address = None
+            self.rate = 0
+            # index of the next frame to go out as a datagram
+            self.udp_sent = 0
+            # MIDI file of the song, for SHEET
+            self.sheet = None
+            # paced sessions are sent their frames in step with the song by a
+            # pacing.PacedStream
+            self.paced = False
+            self.stop_pacing()
+            self.current_frame = -1
+            # frames the board asked for with NEXT but that haven't been sent
+            # yet run from current_frame up to target
+            self.target = 0
+            # number of frames the board acknowledged with RCVD
+            self.acked = 0
+            self.start_time = 0
+
+    def snapshot(self):
+        return {'address': self.address, 'song': self.song,
+                'persistent': self.persistent, 'window': self.window,
+                'current_frame': self.current_frame,
+                'frames': len(self.song_buffer) or self.song_frames,
+                'udp': self.udp_address is not None,
+                'frames_sent': self.frames_sent,
+                'bytes_sent': self.bytes_sent,
+                'pacing': self.pacer.snapshot() if self.pacer else None}
+
+    def release_buffer(self):
+        """ Unpins the song_buffer from the BufferCache it came from. """
+        if self.buffer_lease is not None:
+            self.buffer_lease.release()
+        self.buffer_lease = None
+
+    def finish(self):
+        """ Ends a stream whose last frame has been sent. The buffer is
+        unpinned and dropped, so it stays in memory only as long as the
+        BufferCache's budget allows; the song is kept for STATS, and a
+        START to play it again finds it in the cache if it still is.
+        """
+        with self.lock:
+            self.song_frames = len(self.song_buffer)
+            self.release_buffer()
+            self.song_buffer = []
+            self.stop_pacing()
+            self.current_frame = -1
+            self.target = 0
+
+    def stop_pacing(self):
+        """ Stops sending paced frames, for a new song or the end of one. """
+        if self.pacer is not None:
+            self.pacer.cancel()
+        self.pacer = None
+
+    def seek(self, index):
+        """ Moves the cursor straight to frame index, dropping any frames
+        asked for but not sent yet. Returns False if no stream is open or
+        index is past the end of the song.
+        """
+        with self.lock:
+            if (self.current_frame == -1 or
+                    not 0 <= index < len(self.song_buffer)):
+                return False
+            self.current_frame = index
+            self.target = index
+            self.acked = index
+            self.udp_sent = index
+            if self.pacer is not None:
+                # playback restarts from there
+                self.pacer.anchor(index)
+            return True
+
+    def frames_left(self):
+        """ Frames that have not been sent or asked for yet. """
+        return len(self.song_buffer) - max(self.current_frame, self.target)
+
+    def acknowledge(self, index):
+        """ Records a RCVD for frame index (-1 for the last frame). """
+        with self.lock:
+            if index < 0:
+                index = len(self.song_buffer) - 1
+            self.acked = max(self.acked, min(index + 1, self.current_frame))
+
+    def send_limit(self):
+        """ Frames up to which the session can send right now: what the
+        board asked for, and no more than window frames past the last RCVD.
+        """
+        if self.current_frame == -1:
+            # no stream open
+            return -1
+        if self.window:
+            return min(self.target, self.acked + self.window)
+        return self.target
+
+class BufferLease(object):
+    """ A session's hold on a buffer of a BufferCache. The buffer stays
+    pinned until release() is called or the lease is garbage collected.
+    """
+    def __init__(self, cache, entry):
+        self.buffer = entry.buffer
+        self._release = weakref.finalize(self, cache._unpin, entry)
+
+    def release(self):
+        self._release()
+
+class _CacheEntry(object):
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.nbytes = buffer.nbytes
+        self.pins = 0
+
+class BufferCache(object):
+    """ The frame buffers of recently streamed songs, shared by every
+    session that streams the same song with the same parameters.
+
+    Frame buffers are read-only and sessions only keep a cursor into them,
+    so any number of boards can stream one buffer, each at its own pace, and
+    a song played again finds its frames still in memory. Buffers are kept
+    in least recently used order within budget bytes; a buffer some session
+    holds a lease on is pinned and never evicted, so the cache can only go
+    over budget by the buffers being streamed. STARTs for a song that is
+    still being loaded wait for that load instead of converting the song
+    again.
+    """
+    def __init__(self, budget=BUFFER_CACHE_BYTES):
+        self.budget = budget
+        # cache key -> _CacheEntry, least recently used first
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        # a lock per key being loaded
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if getattr(entry.buffer, 'error', None) is not None:
+                # a failed conversion is tried again
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            entry.pins += 1
+            return entry
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.nbytes -= entry.nbytes
+
+    def _evict(self):
+        # called with the lock held
+        for key in list(self.entries):
+            if self.nbytes <= self.budget:
+                break
+            if not self.entries[key].pins:
+                self._remove(key)
+                stats.incr('buffer_cache_evictions')
+
+    def _unpin(self, entry):
+        with self.lock:
+            entry.pins -= 1
+            self._evict()
+
+    def acquire(self, load_song, song, frame_size, fft_size,
+                ffts_actual_bits, fft_bits, use_cache=True,
+                byte_order=frames.NATIVE, fft_options=None):
+        """ Returns a BufferLease on the buffer of song, loading it with
+        load_song (load_song or load_song_progressive, which take the same
+        arguments) if it isn't in the cache.
+        """
+        key = frame_cache.cache_key(song, fft_size, ffts_actual_bits,
+                                    fft_bits, frame_size, byte_order,
+                                    fft_options)
+        entry = self._get(key)
+        if entry is None:
+            with self.lock:
+                key_lock = self.loading.setdefault(key, threading.Lock())
+            with key_lock:
+                try:
+                    entry = self._get(key)
+                    if entry is None:
+                        stats.incr('buffer_cache_misses')
+                        entry = _CacheEntry(load_song(
+                            song, frame_size, fft_size, ffts_actual_bits,
+                            fft_bits, use_cache, byte_order, fft_options))
+                        with self.lock:
+                            if key in self.entries:
+                                # loaded meanwhile by a START that came
+                                # after this key's lock was dropped
+                                self._remove(key)
+                            entry.pins += 1
+                            self.entries[key] = entry
+                            self.nbytes += entry.nbytes
+                            self._evict()
+                        return BufferLease(self, entry)
+                finally:
+                    # a failed load leaves the next START to try again
+                    with self.lock:
+                        self.loading.pop(key, None)
+        stats.incr('buffer_cache_hits')
+        return BufferLease(self, entry)
+
+    def snapshot(self):
+        with self.lock:
+            return {'buffers': len(self.entries), 'bytes': self.nbytes,
+                    'budget': self.budget,
+                    'pinned': sum(1 for entry in self.entries.values()
+                                  if entry.pins)}
+
+def load_song(song, frame_size, fft_size, ffts_actual_bits, fft_bits,
+              use_cache=True, byte_order=frames.NATIVE, fft_options=None):
+    """ Converts song to packed frames, or maps them from the frame cache.
+
+    Args:
+        song: Path of the .wav file to stream.
+        frame_size: Number of bytes in each frame sent to the board.
+        fft_size: Number of samples in each FFT.
+        ffts_actual_bits: Number of bits the FFT magnitudes are quantized to.
+        fft_bits: Number of bits each point is sent with on the wire.
+        use_cache: Look up and store the frames in the frame cache.
+        byte_order: Byte order of the frames, see frames.pack_records.
+        fft_options: Dict of extra keyword arguments for
+                    wav_to_fft.iter_wav_fft, such as half_spectrum, hop,
+                    window or channels.
+
+    Returns:
+        A frames.FrameBuffer with every frame of the song.
+    """
+    key = frame_cache.cache_key(song, fft_size, ffts_actual_bits, fft_bits,
+                                frame_size, byte_order, fft_options)
+    payload_size = frames.frame_bytes(fft_bits, frame_size)
+    if use_cache:
+        song_buffer = frame_cache.load(key, payload_size)
+        if song_buffer is not None:
+            return song_buffer
+
+    if payload_size == 0:
+        raise ValueError("frame size {} is smaller than a point".format(
+            frame_size))
+
+    # converted a block at a time, so the samples and FFTs of the whole song
+    # are never in memory at once
+    blocks = pack_blocks(song, fft_size, ffts_actual_bits, fft_bits,
+                         frame_size, byte_order, fft_options)
+    if use_cache:
+        # written straight to the cache file and served from the page
+        # cache, so the song is never on the heap
+        return frame_cache.build(key, payload_size, blocks)
+    records = bytearray()
+    for block in blocks:
+        records += block.data
+    return frames.FrameBuffer(records, payload_size)
+
+def prewarm_song(song, frame_size, fft_size, ffts_actual_bits, fft_bits):
+    """ Converts song into the frame cache and returns (song, seconds taken).
+    Runs in a worker process, so only the timing is sent back.
+    """
+    start = time.perf_counter()
+    load_song(song, frame_size, fft_size, ffts_actual_bits, fft_bits)
+    return song, time.perf_counter() - start
+
+def load_song_progressive(song, frame_size, fft_size, ffts_actual_bits,
+                          fft_bits, use_cache=True, byte_order=frames.NATIVE,
+                          fft_options=None):
+    """ Like load_song, but returns before the song is converted.
+
+    Unless the frames are already cached, a ProgressiveFrameBuffer is
+    returned right away and a background thread fills it in order, so
+    streaming can start with the first frames.
+
+    Returns:
+        A frames.FrameBuffer, or frames.ProgressiveFrameBuffer while the song
+        is still being converted.
+    """
+    key = frame_cache.cache_key(song, fft_size, ffts_actual_bits, fft_bits,
+                                frame_size, byte_order, fft_options)
+    payload_size = frames.frame_bytes(fft_bits, frame_size)
+    if use_cache:
+        song_buffer = frame_cache.load(key, payload_size)
+        if song_buffer is not None:
+            return song_buffer
+    if payload_size == 0:
+        raise ValueError("frame size {} is smaller than a point".format(
+            frame_size))
+
+    num_ffts, num_bins = wav_to_fft.fft_shape(song, fft_size,
+                                              **(fft_options or {}))
+    per_fft = frames.frames_per_fft(fft_bits, frame_size, num_bins)
+    song_buffer = frames.ProgressiveFrameBuffer(num_ffts * per_fft,
+                                                payload_size)
+    producer = threading.Thread(target=produce_frames,
+                                args=(song_buffer, song, fft_size,
+                                      ffts_actual_bits, fft_bits, per_fft,
+                                      key if use_cache else None,
+                                      byte_order, fft_options),
+                                daemon=True)
+    producer.start()
+    return song_buffer
+
+def produce_frames(song_buffer, song, fft_size, ffts_actual_bits, fft_bits,
+                   per_fft, key=None, byte_order=frames.NATIVE,
+                   fft_options=None):
+    """ Converts song into song_buffer block by block, then stores it in the
+    frame cache under key if one is given.
+    """
+    try:
+        frame = 0
+        for ffts in wav_to_fft.iter_wav_fft(
+                song, fft_size, ffts_actual_bits,
+                block_windows=PROGRESSIVE_BLOCK_WINDOWS, **(fft_options or {})):
+            count = len(ffts) * per_fft
+            frames.pack_records(song_buffer.records_array(frame, frame + count),
+                                ffts, fft_bits, frame, len(song_buffer),
+                                byte_order)
+            frame += count
+            song_buffer.extend(count)
+        if key is not None:
+            frame_cache.store(key, song_buffer)
+    except Exception as e:
+        song_buffer.fail(e)
+
+def pack_blocks(song, fft_size, ffts_actual_bits, fft_bits, frame_size,
+                byte_order=frames.NATIVE, fft_options=None,
+                block_windows=LOAD_BLOCK_WINDOWS):
+    """ Converts song block_windows FFTs at a time and yields each block as
+    an array of wire-ready records, in song order.
+    """
+    fft_options = fft_options or {}
+    num_ffts, num_bins = wav_to_fft.fft_shape(song, fft_size, **fft_options)
+    per_fft = frames.frames_per_fft(fft_bits, frame_size, num_bins)
+    num_frames = num_ffts * per_fft
+    record_size = frames.HEADER_SIZE + frames.frame_bytes(fft_bits, frame_size)
+    frame = 0
+    for ffts in wav_to_fft.iter_wav_fft(song, fft_size, ffts_actual_bits,
+                                        block_windows=block_windows,
+                                        **fft_options):
+        records = numpy.empty((len(ffts) * per_fft, record_size),
+                              dtype=numpy.uint8)
+        frames.pack_records(records, ffts, fft_bits, frame, num_frames,
+                            byte_order)
+        frame += len(records)
+        yield records
@@ -0,0 +1,234 @@
+# This file turns the MIDI files of the songs into the sheet music the
+# server sends for SHEET. A MIDI file is parsed once into a table of note
+# events (time, note, velocity, channel) held in a numpy array, which is
+# cached on disk next to the frame cache and memory-mapped from there, so the
+# events of any range of frames are found with two binary searches and sent
+# without the board ever parsing MIDI.
+import functools
+import hashlib
+import numpy
+import os
+import tempfile
+
+SHEET_CACHE_DIRECTORY = "sheet_cache"
+SHEET_CACHE_EXT = ".npy"
+
+# Bump whenever the layout of the cached tables changes.
+SHEET_VERSION = 1
+
+# One note event: microseconds from the start of the song, MIDI note number,
+# velocity (0 for a note off) and MIDI channel.
+EVENT_DTYPE = numpy.dtype([('time_us', '<u8'), ('note', 'u1'),
+                           ('velocity', 'u1'), ('channel', 'u1')])
+
+# Tempo of a MIDI file until its first set tempo event, 120 bpm.
+DEFAULT_TEMPO = 500000
+
+class MidiError(ValueError):
+    """ Raised for a file that can't be parsed as a standard MIDI file. """
+
+def read_varlen(data, offset):
+    """ Reads a MIDI variable length quantity, returns (value, offset). """
+    value = 0
+    while True:
+        if offset >= len(data):
+            raise MidiError("truncated variable length quantity")
+        byte = data[offset]
+        offset += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, offset
+
+def read_track(data, track):
+    """ Parses one MTrk chunk.
+
+    Returns:
+        (notes, tempos): lists of (tick, note, velocity, channel) and of
+        (tick, microseconds per quarter note).
+    """
+    notes = []
+    tempos = []
+    tick = 0
+    offset = 0
+    status = None
+    while offset < len(data):
+        delta, offset = read_varlen(data, offset)
+        tick += delta
+        if offset >= len(data):
+            raise MidiError("truncated event in track {}".format(track))
+        if data[offset] & 0x80:
+            status = data[offset]
+            offset += 1
+        elif status is None or status >= 0xF0:
+            raise MidiError("running status without a status in track "
+                            "{}".format(track))
+        if status == 0xFF:
+            if offset >= len(data):
+                raise MidiError("truncated event in track {}".format(track))
+            kind = data[offset]
+            length, offset = read_varlen(data, offset + 1)
+            if offset + length > len(data):
+                raise MidiError("truncated event in track {}".format(track))
+            if kind == 0x51 and length == 3:
+                tempos.append((tick, int.from_bytes(data[offset:offset + 3],
+                                                    byteorder='big')))
+            offset += length
+            if kind == 0x2F:
+                # end of track
+                break
+            status = None
+        elif status in (0xF0, 0xF7):
+            length, offset = read_varlen(data, offset)
+            if offset + length > len(data):
+                raise MidiError("truncated event in track {}".format(track))
+            offset += length
+            status = None
+        else:
+            kind = status & 0xF0
+            size = 1 if kind in (0xC0, 0xD0) else 2
+            if offset + size > len(data):
+                raise MidiError("truncated event in track {}".format(track))
+            if kind == 0x90:
+                notes.append((tick, data[offset], data[offset + 1],
+                              status & 0x0F))
+            elif kind == 0x80:
+                notes.append((tick, data[offset], 0, status & 0x0F))
+            offset += size
+    return notes, tempos
+
+def parse_midi(file_name):
+    """ Parses a standard MIDI file (format 0 or 1) into note events.
+
+    Returns:
+        An EVENT_DTYPE array of every note on and off in the file, in time
+        order (file order for events at the same time).
+
+    Raises:
+        MidiError: The file is not a standard MIDI file.
+    """
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'MThd' or len(data) < 14:
+        raise MidiError("file does not start with an MThd chunk")
+    header_size = int.from_bytes(data[4:8], byteorder='big')
+    num_tracks = int.from_bytes(data[10:12], byteorder='big')
+    division = int.from_bytes(data[12:14], byteorder='big')
+    if not division or (division & 0x8000 and not division & 0xFF):
+        raise MidiError("no ticks per quarter note or frame")
+
+    notes = []
+    tempos = []
+    offset = 8 + header_size
+    for track in range(num_tracks):
+        if data[offset:offset + 4] != b'MTrk':
+            raise MidiError("track {} is not an MTrk chunk".format(track))
+        size = int.from_bytes(data[offset + 4:offset + 8], byteorder='big')
+        if offset + 8 + size > len(data):
+            raise MidiError("track {} is truncated".format(track))
+        track_notes, track_tempos = read_track(
+            data[offset + 8:offset + 8 + size], track)
+        notes += track_notes
+        tempos += track_tempos
+        offset += 8 + size
+
+    events = numpy.zeros(len(notes), dtype=EVENT_DTYPE)
+    if not notes:
+        return events
+    ticks = numpy.array([note[0] for note in notes], dtype=numpy.int64)
+    events['note'] = [note[1] for note in notes]
+    events['velocity'] = [note[2] for note in notes]
+    events['channel'] = [note[3] for note in notes]
+    events['time_us'] = ticks_to_us(ticks, tempos, division)
+    return events[numpy.argsort(events['time_us'], kind='stable')]
+
+def ticks_to_us(ticks, tempos, division):
+    """ Converts MIDI ticks to microseconds with the file's tempo map. """
+    if division & 0x8000:
+        # SMPTE time: frames per second and ticks per frame
+        fps = 256 - (division >> 8)
+        return ticks * 1000000 // (fps * (division & 0xFF))
+    tempos = sorted(tempos)
+    if not tempos or tempos[0][0] > 0:
+        tempos.insert(0, (0, DEFAULT_TEMPO))
+    starts = numpy.array([tick for tick, tempo in tempos], dtype=numpy.int64)
+    rates = numpy.array([tempo for tick, tempo in tempos], dtype=numpy.int64)
+    # microseconds at the start of each tempo, in ticks * us per quarter
+    elapsed = numpy.concatenate(([0], numpy.cumsum(numpy.diff(starts) *
+                                                   rates[:-1])))
+    segment = numpy.searchsorted(starts, ticks, side='right') - 1
+    return (elapsed[segment] + (ticks - starts[segment]) * rates[segment]) \
+        // division
+
+def cache_path(file_name, directory=SHEET_CACHE_DIRECTORY):
+    # the MIDI file's modification time and size are part of the key, so an
+    # edited file is parsed again
+    path = os.path.abspath(file_name)
+    st = os.stat(path)
+    key = (SHEET_VERSION, path, st.st_mtime_ns, st.st_size)
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(directory, digest + SHEET_CACHE_EXT)
+
+def load(file_name, directory=SHEET_CACHE_DIRECTORY):
+    """ Returns the Sheet of a MIDI file, parsing it only if it isn't in
+    the cache yet.
+    """
+    return _load(cache_path(file_name, directory), file_name)
+
+@functools.lru_cache(maxsize=64)
+def _load(path, file_name):
+    try:
+        events = numpy.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        events = parse_midi(file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name and renamed into place, as in
+        # frame_cache
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, events)
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+    return Sheet(events)
+
+class Sheet(object):
+    """ The note events of a song, looked up by FFT window. """
+    def __init__(self, events):
+        self.events = events
+
+    def __len__(self):
+        return len(self.events)
+
+    def windows(self, first, stop, sample_rate, hop):
+        """ Events that fall in FFT windows [first, stop) of a stream with
+        a window every hop samples at sample_rate.
+
+        Returns:
+            (events, windows): the events, and the window each falls in.
+        """
+        # window w starts at w * hop / sample_rate seconds, rounded up to
+        # the next whole microsecond an event can be at
+        bounds = [-(-(window * hop * 1000000) // sample_rate)
+                  for window in (first, stop)]
+        start, end = numpy.searchsorted(self.events['time_us'], bounds)
+        events = self.events[start:end]
+        windows = events['time_us'] * sample_rate // (hop * 1000000)
+        return events, windows
+
+def encode_events(events, frame_indexes, byte_order='='):
+    """ Encodes events as the SHEET response: the number of events in four
+    big endian bytes, then one eight byte record per event with the index of
+    its frame (four bytes, in byte_order), note, velocity, channel and a
+    zero byte.
+    """
+    records = numpy.zeros(len(events), dtype=numpy.dtype(
+        [('frame', byte_order + 'u4'), ('note', 'u1'), ('velocity', 'u1'),
+         ('channel', 'u1'), ('pad', 'u1')]))
+    records['frame'] = frame_indexes
+    records['note'] = events['note']
+    records['velocity'] = events['velocity']
+    records['channel'] = events['channel']
+    return len(records).to_bytes(4, byteorder='big') + records.tobytes()
@@ -0,0 +1,108 @@
+# This file collects timing and throughput counters for the hot paths of the
+# server (wav decode, FFT, packing, cache lookups, sends, accepts). Updates are
+# cheap enough to leave on in production, and snapshot() returns everything as
+# a dict that the server sends back for the STATS request.
+import collections
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds of history kept for rates.
+RATE_WINDOW = 60
+
+class Histogram(object):
+    """ Histogram of durations in nanoseconds, in power of two buckets. """
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[min(value.bit_length(), 63)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        # bucket i holds values below 2**i ns, keyed by that upper bound
+        buckets = {}
+        for i, count in enumerate(self.buckets):
+            if count:
+                buckets[str(1 << i)] = count
+        return {'count': self.count, 'total_ns': self.total,
+                'min_ns': self.min or 0, 'max_ns': self.max,
+                'mean_ns': self.total // self.count if self.count else 0,
+                'buckets': buckets}
+
+class Rate(object):
+    """ Events per second over the last RATE_WINDOW seconds. """
+    def __init__(self):
+        self.slots = [0] * RATE_WINDOW
+        self.seconds = [0] * RATE_WINDOW
+
+    def add(self, count=1):
+        now = int(time.monotonic())
+        slot = now % RATE_WINDOW
+        if self.seconds[slot] != now:
+            self.seconds[slot] = now
+            self.slots[slot] = 0
+        self.slots[slot] += count
+
+    def per_second(self):
+        now = int(time.monotonic())
+        total = 0
+        for slot in range(RATE_WINDOW):
+            if now - self.seconds[slot] < RATE_WINDOW:
+                total += self.slots[slot]
+        return total / RATE_WINDOW
+
+lock = threading.Lock()
+started = time.monotonic()
+counters = collections.Counter()
+histograms = collections.defaultdict(Histogram)
+rates = collections.defaultdict(Rate)
+
+def incr(name, count=1):
+    with lock:
+        counters[name] += count
+
+def observe(name, nanoseconds):
+    with lock:
+        histograms[name].add(nanoseconds)
+
+def mark(name, count=1):
+    """ Counts an event both in total and in the rate of name. """
+    with lock:
+        counters[name] += count
+        rates[name].add(count)
+
+@contextmanager
+def timed(name):
+    """ Records the time spent in the with block in histogram name. """
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter_ns() - start)
+
+def snapshot():
+    with lock:
+        return {'uptime_s': time.monotonic() - started,
+                'counters': dict(counters),
+                'rates_per_s': dict((name, rate.per_second())
+                                    for name, rate in rates.items()),
+                'histograms': dict((name, histogram.snapshot())
+                                   for name, histogram in histograms.items())}
+
+def encode(snapshot):
+    """ Encodes a snapshot as the STATS response: the length of the JSON
+    document in four big endian bytes, then the document.
+    """
+    document = json.dumps(snapshot, separators=(',', ':')).encode('utf-8')
+    return len(document).to_bytes(4, byteorder='big') + document
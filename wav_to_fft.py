@@ -2,23 +2,63 @@
 # ffts, where each fft is the result of fft_length samples specified by the
 # caller. It leverages scipy for performing the FFT, matplotlib for optional
 # debugging of data, and wave for reading wave files.
+import functools
 import matplotlib.pyplot as plt
+import mmap
 import numpy
 import wave
 from math import ceil
-
-numpy.set_printoptions(threshold=numpy.nan)
+from numpy.lib.stride_tricks import sliding_window_view
 
 # struct is used to convert wav file data from bytes to floats.
 import struct
 import os
 import sys
 
+import stats
+
+numpy.set_printoptions(threshold=sys.maxsize)
+
 # Wave files store floats in 32 bit values (if they use that precision).
 FLOAT_ENCODE = 4
 
 VERBOSE = False
 
+# Number of FFT windows transformed per numpy call by the batched engine. This
+# bounds the size of the temporary complex matrix for long songs.
+FFT_BATCH_WINDOWS = 4096
+
+# Window functions that can be applied to each FFT window, by name. The
+# periodic form is used, as is usual for spectral analysis; None is the
+# rectangular window, i.e. no window at all.
+WINDOW_FUNCTIONS = {
+    'rect': None,
+    'hann': numpy.hanning,
+    'hamming': numpy.hamming,
+    'blackman': numpy.blackman,
+}
+
+# Channel selections of a multichannel song: CHANNELS_MIX downmixes every
+# channel to mono before the FFT, CHANNELS_ALL takes an FFT of each channel
+# for every window. Any other selection is the index of a single channel.
+CHANNELS_MIX = 'mix'
+CHANNELS_ALL = 'all'
+
+# numpy dtypes for the little-endian sample widths stored in wav files. 8 bit
+# samples are unsigned and centered on 128, 24 bit samples have no numpy dtype
+# and are assembled byte by byte.
+SAMPLE_DTYPES = {1: '<u1', 2: '<i2', 4: '<i4'}
+
+# numpy dtypes for the widths of IEEE float samples.
+FLOAT_DTYPES = {4: '<f4', 8: '<f8'}
+
+# Format tags of the fmt chunk. Integer PCM and IEEE float samples of the
+# same width are told apart by the tag, or by the first two bytes of the
+# subformat GUID for WAVE_FORMAT_EXTENSIBLE.
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
 def convert_wav_to_fft(file_name, points_per_fft, max_range_bits=16, \
                        mod_freqs=0):
     """ Function used to convert a .wav file into an array of FFTs.
@@ -158,6 +198,449 @@ def convert_wav_to_fft(file_name, points_per_fft, max_range_bits=16, \
         print(ffts[0].astype(int))
     return ffts
 
+def decode_samples(frame_data, bytes_per_samp, num_channels, channel=0,
+                   float_samples=False):
+    """ Decodes a block of raw wav frames into samples at once.
+
+    The interleaved channels are split apart with a single strided reshape of
+    the block, for one channel or all of them.
+
+    Args:
+        frame_data: The bytes returned by wave.readframes, a block of
+                    WavData, or any other buffer holding whole frames.
+        bytes_per_samp: Width of a single sample in bytes (1, 2, 3 or 4, or
+                    4 or 8 for floats).
+        num_channels: Number of interleaved channels in each frame.
+        channel: The channel to extract, or None for every channel.
+        float_samples: Whether the samples are IEEE floats rather than
+                    integer PCM, see WavData.float_samples.
+
+    Returns:
+        A float64 numpy array with one (unnormalized) value per frame, or of
+        shape (frames, num_channels) if channel is None.
+    """
+    bytes_per_frame = bytes_per_samp * num_channels
+    num_frames = len(frame_data) // bytes_per_frame
+
+    raw = numpy.frombuffer(frame_data, dtype=numpy.uint8,
+                           count=num_frames * bytes_per_frame)
+    raw = raw.reshape(num_frames, num_channels, bytes_per_samp)
+    if channel is not None:
+        raw = raw[:, channel, :]
+
+    if (bytes_per_samp == 3):
+        # Assemble the little endian bytes and sign extend from bit 23.
+        samples = (raw[..., 0].astype(numpy.int32) |
+                   (raw[..., 1].astype(numpy.int32) << 8) |
+                   (raw[..., 2].astype(numpy.int32) << 16))
+        samples = (samples ^ 0x800000) - 0x800000
+    else:
+        dtype = (FLOAT_DTYPES if float_samples else
+                 SAMPLE_DTYPES)[bytes_per_samp]
+        samples = numpy.ascontiguousarray(raw).view(dtype).reshape(
+            raw.shape[:-1])
+    if (bytes_per_samp == 1 and not float_samples):
+        return samples.astype(numpy.float64) - 128
+    return samples.astype(numpy.float64)
+
+def decode_channels(frame_data, bytes_per_samp, num_channels, channels=0,
+                    float_samples=False):
+    """ Decodes a block of raw wav frames for a channel selection.
+
+    Returns:
+        The samples of one channel, of the downmix of all channels for
+        CHANNELS_MIX, or a (frames, num_channels) array for CHANNELS_ALL.
+    """
+    if channels == CHANNELS_MIX:
+        samples = decode_samples(frame_data, bytes_per_samp, num_channels,
+                                 None, float_samples)
+        return samples.mean(axis=1)
+    if channels == CHANNELS_ALL:
+        return decode_samples(frame_data, bytes_per_samp, num_channels, None,
+                              float_samples)
+    return decode_samples(frame_data, bytes_per_samp, num_channels, channels,
+                          float_samples)
+
+def channel_ffts(num_channels, channels=0):
+    """ Number of FFTs taken per window of a song with num_channels channels
+    for a channel selection, 0 if it selects a channel the song doesn't have.
+    """
+    if channels == CHANNELS_ALL:
+        return num_channels
+    if channels == CHANNELS_MIX:
+        return 1
+    return 1 if 0 <= channels < num_channels else 0
+
+def fft_bins(points_per_fft, mod_freqs=0, half_spectrum=False):
+    """ Number of magnitudes ffts_from_samples returns per window. """
+    if (half_spectrum):
+        return points_per_fft // 2 + 1
+    return points_per_fft // 2 if mod_freqs else points_per_fft
+
+@functools.lru_cache(maxsize=None)
+def window_function(window, points_per_fft):
+    """ The samples of the named window function, or None for 'rect'. """
+    function = WINDOW_FUNCTIONS[window]
+    if function is None:
+        return None
+    # periodic window: the symmetric one of length n + 1, minus its last point
+    return function(points_per_fft + 1)[:-1]
+
+def window_count(num_samples, points_per_fft, hop=None):
+    """ Number of windows ffts_from_samples takes over num_samples samples:
+    one starting at every multiple of hop, the last ones padded with zeros.
+    """
+    return ceil(num_samples / (hop or points_per_fft))
+
+def ffts_from_samples(sound_data, points_per_fft, max_range_bits=16,
+                      mod_freqs=0, halve_last=True, half_spectrum=False,
+                      hop=None, window='rect', num_windows=None):
+    """ Runs a batched FFT over windows of sound_data.
+
+    Window i covers samples [i * hop, i * hop + points_per_fft), so windows
+    overlap when hop is less than points_per_fft and are back to back by
+    default. They are taken as a strided view of the samples rather than
+    copied, and transformed FFT_BATCH_WINDOWS rows at a time, with the window
+    function and the min/max normalization applied per row. With the default
+    hop and window, the output matches convert_wav_to_fft except that silent
+    windows (where min == max) come out as zeros instead of NaN.
+
+    sound_data can also hold several channels, one per column. Every channel
+    of every window is then transformed in the same batched FFT and
+    normalized on its own, and the FFTs of window i are rows
+    i * channels to (i + 1) * channels - 1 of the output, in channel order.
+
+    With half_spectrum set, a real FFT is used instead and only the
+    points_per_fft // 2 + 1 non-redundant bins, DC up to and including
+    Nyquist, are returned. Every bin but DC and Nyquist is doubled to account
+    for its mirror image, and halve_last is ignored.
+
+    Args:
+        sound_data: Normalized float samples of a single channel, or a
+                    (samples, channels) array of several.
+        points_per_fft: The number of samples in each FFT window.
+        max_range_bits: The number of bits used to represent the FFT magnitudes
+        mod_freqs: Only keep the positive frequency content if set.
+        halve_last: Halve the last bin of every window, as convert_wav_to_fft
+                    does for wav files with an even number of frames.
+        half_spectrum: Only return the non-redundant half of the spectrum.
+        hop: The number of samples between the starts of two windows,
+                    points_per_fft if None.
+        window: The name of the window function, a key of WINDOW_FUNCTIONS.
+        num_windows: The number of windows to transform, window_count of
+                    the samples if None. The samples past the end of
+                    sound_data are taken as zeros.
+
+    Returns:
+        A float64 numpy array of shape (n_windows * channels,
+        fft_bins(points_per_fft, mod_freqs, half_spectrum)).
+    """
+    hop = hop or points_per_fft
+    samples = sound_data.reshape(len(sound_data), -1)
+    num_channels = samples.shape[1]
+    if num_windows is None:
+        num_windows = window_count(len(samples), points_per_fft, hop)
+    # only the samples the windows reach, zero padded at the end
+    length = max(num_windows - 1, 0) * hop + points_per_fft
+    padded = numpy.zeros((length, num_channels))
+    used = min(len(samples), length)
+    padded[:used] = samples[:used]
+    # (windows, channels, points_per_fft), without copying any sample
+    windows = sliding_window_view(padded, points_per_fft, axis=0)[::hop][
+        :num_windows]
+    coefficients = window_function(window, points_per_fft)
+
+    num_bins = fft_bins(points_per_fft, mod_freqs, half_spectrum)
+    ffts = numpy.empty(shape=(num_windows * num_channels, num_bins))
+    for start in range(0, num_windows, FFT_BATCH_WINDOWS):
+        block = windows[start:start + FFT_BATCH_WINDOWS]
+        if coefficients is not None:
+            block = block * coefficients
+        if (half_spectrum):
+            freqs = numpy.abs(numpy.fft.rfft(block, axis=-1))
+            # DC and Nyquist have no mirror image, so only the bins between
+            # them are doubled
+            freqs /= float(points_per_fft)
+            freqs[..., 1:(points_per_fft + 1) // 2] *= 2
+        else:
+            freqs = numpy.abs(numpy.fft.fft(block, axis=-1))
+
+            # Normalize the FFT by its length and double positive frequency
+            # values.
+            freqs = (freqs / float(points_per_fft)) * 2
+
+        # normalize each window of each channel between 0 and
+        # 2**max_range_bits
+        min_freq = numpy.amin(freqs, axis=-1, keepdims=True)
+        max_freq = numpy.amax(freqs, axis=-1, keepdims=True)
+        span = max_freq - min_freq
+        flat = (span == 0)
+        span[flat] = 1
+        freqs = (freqs - min_freq) * (2**(max_range_bits) - 1) / span
+        freqs[flat[..., 0]] = 0
+
+        if (halve_last and not half_spectrum):
+            freqs[..., -1] = freqs[..., -1] / 2
+
+        ffts[start * num_channels:(start + len(block)) * num_channels] = \
+            freqs[..., :num_bins].reshape(-1, num_bins)
+    return ffts
+
+class WavData(object):
+    """ The sample data of a wav file, memory-mapped instead of read.
+
+    Only the RIFF header is parsed up front. The data chunk is mapped
+    read-only and handed out as memoryviews of whole frames, so decoding a
+    song touches one block of it at a time and the pages of blocks already
+    consumed by blocks() are dropped again, keeping memory use flat however
+    long the file is.
+
+    Raises:
+        wave.Error: The file is not a RIFF/WAVE file with a fmt and a data
+                    chunk, or its samples are neither integer PCM nor IEEE
+                    floats of a width decode_samples handles.
+    """
+    def __init__(self, file_name):
+        self.file = open(os.path.abspath(file_name), 'rb')
+        try:
+            self._read_header()
+            file_size = os.fstat(self.file.fileno()).st_size
+            # a truncated file holds fewer frames than its header says
+            data_size = max(min(self.data_size, file_size - self.data_offset), 0)
+            self.num_frames = data_size // self.bytes_per_frame
+            self.mmap = None
+            self.data = memoryview(b"")
+            if self.num_frames:
+                self.mmap = mmap.mmap(self.file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    self.mmap.madvise(mmap.MADV_SEQUENTIAL)
+                self.data = memoryview(self.mmap)[
+                    self.data_offset:
+                    self.data_offset + self.num_frames * self.bytes_per_frame]
+        except:
+            self.file.close()
+            raise
+
+    def _read_header(self):
+        riff = self.file.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:] != b'WAVE':
+            raise wave.Error("file does not start with a RIFF/WAVE header")
+        fmt = None
+        while True:
+            header = self.file.read(8)
+            if len(header) < 8:
+                raise wave.Error("no data chunk found")
+            chunk_id = header[:4]
+            chunk_size = int.from_bytes(header[4:], byteorder='little')
+            if chunk_id == b'fmt ':
+                fmt = self.file.read(chunk_size)
+                if len(fmt) < 16:
+                    raise wave.Error("fmt chunk too short")
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise wave.Error("data chunk before fmt chunk")
+                self.data_offset = self.file.tell()
+                self.data_size = chunk_size
+                break
+            else:
+                self.file.seek(chunk_size, os.SEEK_CUR)
+            # chunks are padded to an even length
+            if chunk_size % 2:
+                self.file.seek(1, os.SEEK_CUR)
+
+        (self.format_tag, self.num_channels, self.samp_freq, byte_rate,
+         block_align, bits_per_samp) = struct.unpack('<HHIIHH', fmt[:16])
+        if self.format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 40:
+            # the actual format is in the first two bytes of the subformat
+            self.format_tag = int.from_bytes(fmt[24:26], byteorder='little')
+        self.float_samples = (self.format_tag == WAVE_FORMAT_IEEE_FLOAT)
+        self.bytes_per_samp = (bits_per_samp + 7) // 8
+        if self.float_samples:
+            widths = FLOAT_DTYPES
+        elif self.format_tag == WAVE_FORMAT_PCM:
+            widths = (1, 2, 3, 4)
+        else:
+            raise wave.Error("unsupported format tag 0x{:04x}".format(
+                self.format_tag))
+        if self.bytes_per_samp not in widths:
+            raise wave.Error("unsupported {} bit {} samples".format(
+                bits_per_samp, "float" if self.float_samples else "PCM"))
+        self.bytes_per_frame = self.bytes_per_samp * self.num_channels
+        if self.bytes_per_frame == 0:
+            raise wave.Error("bad sample width or channel count")
+
+    def frames(self, start, count):
+        """ Raw bytes of count frames from frame start, as a memoryview. """
+        stop = min(start + count, self.num_frames)
+        return self.data[start * self.bytes_per_frame:
+                         stop * self.bytes_per_frame]
+
+    def blocks(self, frames_per_block, overlap=0):
+        """ Yields the data chunk frames_per_block frames at a time, each
+        block followed by the first overlap frames of the next one.
+
+        Once the caller asks for the next block, the pages of the previous
+        one are released from the mapping (they stay in the page cache).
+        """
+        released = 0
+        for start in range(0, self.num_frames, frames_per_block):
+            yield self.frames(start, frames_per_block + overlap)
+            end = self.data_offset + (start + frames_per_block) * \
+                    self.bytes_per_frame
+            end = min(end, len(self.mmap)) // mmap.PAGESIZE * mmap.PAGESIZE
+            if end > released and hasattr(mmap, 'MADV_DONTNEED'):
+                self.mmap.madvise(mmap.MADV_DONTNEED, released, end - released)
+                released = end
+
+    def close(self):
+        self.data.release()
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # a block is still referenced, the mapping goes with it
+                pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def convert_wav_to_fft_batched(file_name, points_per_fft, max_range_bits=16,
+                               mod_freqs=0, half_spectrum=False, hop=None,
+                               window='rect', channels=0):
+    """ Vectorized equivalent of convert_wav_to_fft.
+
+    The wav file is memory-mapped and decoded FFT_BATCH_WINDOWS windows at a
+    time by iter_wav_fft, straight into the returned matrix, instead of one
+    sample and one window at a time from a full copy of the file.
+
+    Args:
+        file_name: The path to the .wav file you want frequency information
+                    from.
+        points_per_fft: The number of samples of the audio file to accumulate
+                            into an FFT.
+        max_range_bits: The number of bits used to represent the FFT magnitudes
+        mod_freqs: Only keep the positive frequency content if set.
+        half_spectrum: Only keep the non-redundant bins of a real FFT, see
+                    ffts_from_samples.
+        hop: The number of samples between the starts of two windows.
+        window: The name of the window function, see WINDOW_FUNCTIONS.
+        channels: The channel to take FFTs of, CHANNELS_MIX or CHANNELS_ALL.
+
+    Returns:
+        A numpy array whose ith row is the FFT of the ith window of
+        points_per_fft samples (of the ith FFT with CHANNELS_ALL, see
+        ffts_from_samples). Returns None if the file does not exist.
+    """
+    fpath = os.path.abspath(file_name)
+    try:
+        wav_data = WavData(fpath)
+    except (OSError, wave.Error):
+        print("ERROR: {} is not a valid wav file path.\n".format(fpath))
+        return None
+
+    with wav_data:
+        if (wav_data.num_channels != 1 and channels == 0):
+            print("WARNING: {} is not a mono file. ".format(fpath) +
+                    "Taking first channel only.\n")
+        num_bins = fft_bins(points_per_fft, mod_freqs, half_spectrum)
+        ffts = numpy.empty(shape=(window_count(wav_data.num_frames,
+                                               points_per_fft, hop) *
+                                  channel_ffts(wav_data.num_channels,
+                                               channels),
+                                  num_bins))
+        row = 0
+        for block in wav_fft_blocks(wav_data, points_per_fft, max_range_bits,
+                                    mod_freqs, FFT_BATCH_WINDOWS,
+                                    half_spectrum, hop, window, channels):
+            ffts[row:row + len(block)] = block
+            row += len(block)
+    return ffts
+
+def fft_window_count(file_name, points_per_fft, hop=None):
+    """ Number of FFTs convert_wav_to_fft_batched returns for file_name,
+    read from the wav header only.
+    """
+    with WavData(file_name) as wav_data:
+        return window_count(wav_data.num_frames, points_per_fft, hop)
+
+def fft_shape(file_name, points_per_fft, mod_freqs=0, half_spectrum=False,
+              hop=None, window='rect', channels=0):
+    """ Shape (FFTs, bins) of what iter_wav_fft yields for file_name with
+    the same arguments, read from the wav header only.
+    """
+    with WavData(file_name) as wav_data:
+        num_ffts = (window_count(wav_data.num_frames, points_per_fft, hop) *
+                    channel_ffts(wav_data.num_channels, channels))
+    return num_ffts, fft_bins(points_per_fft, mod_freqs, half_spectrum)
+
+def iter_wav_fft(file_name, points_per_fft, max_range_bits=16, mod_freqs=0,
+                 block_windows=FFT_BATCH_WINDOWS, half_spectrum=False,
+                 hop=None, window='rect', channels=0):
+    """ Streaming variant of convert_wav_to_fft_batched.
+
+    The wav file is memory-mapped and transformed block_windows FFTs at a
+    time, so the first FFTs are available long before the end of the song is
+    decoded, and memory use depends on block_windows rather than on the
+    length of the song.
+
+    Args:
+        file_name: The path to the .wav file you want frequency information
+                    from.
+        points_per_fft: The number of samples of the audio file to accumulate
+                            into an FFT.
+        max_range_bits: The number of bits used to represent the FFT magnitudes
+        mod_freqs: Only keep the positive frequency content if set.
+        block_windows: The number of windows in each yielded block.
+        half_spectrum: Only keep the non-redundant bins of a real FFT, see
+                    ffts_from_samples.
+        hop: The number of samples between the starts of two windows.
+        window: The name of the window function, see WINDOW_FUNCTIONS.
+        channels: The channel to take FFTs of, CHANNELS_MIX or CHANNELS_ALL.
+
+    Yields:
+        numpy arrays of up to block_windows rows which, concatenated, are the
+        rows convert_wav_to_fft_batched returns.
+    """
+    with WavData(file_name) as wav_data:
+        yield from wav_fft_blocks(wav_data, points_per_fft, max_range_bits,
+                                  mod_freqs, block_windows, half_spectrum,
+                                  hop, window, channels)
+
+def wav_fft_blocks(wav_data, points_per_fft, max_range_bits, mod_freqs,
+                   block_windows, half_spectrum=False, hop=None,
+                   window='rect', channels=0):
+    # wav files with an even number of frames get their last bin halved, see
+    # convert_wav_to_fft
+    halve_last = (wav_data.num_frames % 2 == 0)
+    hop = hop or points_per_fft
+    num_windows = window_count(wav_data.num_frames, points_per_fft, hop)
+    # each block also reads the samples its last windows share with the
+    # next block
+    overlap = max(points_per_fft - hop, 0)
+    first = 0
+    for frame_data in wav_data.blocks(block_windows * hop, overlap):
+        with stats.timed('wav_decode'):
+            sound_data = decode_channels(frame_data, wav_data.bytes_per_samp,
+                                         wav_data.num_channels, channels,
+                                         wav_data.float_samples)
+            if not wav_data.float_samples:
+                # float samples are in [-1, 1] already
+                sound_data /= 2.**(wav_data.bytes_per_samp * 8 - 1)
+        # drop our view before the block's pages are released
+        frame_data.release()
+        with stats.timed('fft'):
+            count = min(block_windows, num_windows - first)
+            ffts = ffts_from_samples(sound_data, points_per_fft,
+                                     max_range_bits, mod_freqs, halve_last,
+                                     half_spectrum, hop, window, count)
+            first += count
+        yield ffts
+
 if __name__ == "__main__":
     if (len(sys.argv) == 2 and sys.argv[1] == '-v'):
         VERBOSE = True